@@ -2,6 +2,7 @@ import os
 import nibabel as nib
 import numpy as np
 from scipy.ndimage import zoom
+from segmentator.io_utils import save_nifti
 
 #config
 
@@ -74,7 +75,7 @@ def process_nii(filepath, output_dir, target_shape, target_spacing):
     # Step 3: Save new NIfTI
     resampled_img = nib.Nifti1Image(final_data, new_affine, img.header)
     output_path = os.path.join(output_dir, os.path.basename(filepath))
-    nib.save(resampled_img, output_path)
+    save_nifti(resampled_img, output_path)
     print(f"Saved: {output_path}")
 
 def batch_process(input_dir, output_dir, target_shape, target_spacing):
@@ -2,6 +2,7 @@ import os
 import nibabel as nib
 import numpy as np
 from scipy.ndimage import zoom
+from segmentator.io_utils import save_nifti
 
 # ===================== CONFIG ======================
 
@@ -35,7 +36,7 @@ def process_nii(filepath, output_dir, target_shape):
 
     # Create the output file path and save the resampled image
     output_path = os.path.join(output_dir, os.path.basename(filepath))
-    nib.save(resampled_img, output_path)
+    save_nifti(resampled_img, output_path)
     print(f"Saved: {output_path}")
 
 def batch_resample(input_dir, output_dir, target_shape):
@@ -21,12 +21,13 @@ def main():
     # Add arguments to namespace:
     parser.add_argument(
         'filename', metavar='path',
-        help="Path to input. Mostly a nifti file with image data."
+        help="Path to input. Mostly a nifti file with image data, or a \
+        directory with a DICOM series (needs pydicom)."
         )
     parser.add_argument(
         "--gramag", metavar=str(cfg.gramag), required=False,
         default=cfg.gramag,
-        help="'scharr', 'deriche', 'sobel', 'prewitt', 'numpy' \
+        help="'scharr', 'deriche', 'sobel', 'prewitt', 'numpy', 'gaussian' \
         or path to a gradient magnitude nifti."
         )
     # used in Deriche filter gradient magnitude computation
@@ -38,6 +39,15 @@ def main():
         is strong noise in the input image or the features of interest are at \
         a different scale compared to original image resolution."
         )
+    # used in Gaussian derivative gradient magnitude computation
+    parser.add_argument(
+        "--gramag_sigma", required=False, type=float,
+        default=cfg.gramag_sigma, metavar=cfg.gramag_sigma,
+        help="Used only in Gaussian gradient magnitude option. Standard \
+        deviation of the Gaussian in the units of the voxel dimensions \
+        (pixdim, often mm). Larger sigma values suppress more noise and \
+        smaller edges."
+        )
     parser.add_argument(
         "--scale", metavar=str(cfg.scale), required=False, type=float,
         default=cfg.scale,
@@ -63,6 +73,11 @@ def main():
         default=cfg.valmax,
         help="Maximum value, overwrites percentile."
         )
+    parser.add_argument(
+        "--exact_percentiles", action='store_true',
+        help="Compute exact percentiles by sorting the data instead of \
+        estimating them from a fine histogram. Slower and uses more memory."
+        )
     parser.add_argument(
         "--cbar_max",  metavar=str(cfg.cbar_max), required=False,  type=float,
         default=cfg.cbar_max,
@@ -82,6 +97,15 @@ def main():
         "--nogui", action='store_true',
         help="Only save 2D histogram image without showing GUI."
         )
+    parser.add_argument(
+        "--slab_depth", metavar=str(cfg.slab_depth), required=False,
+        type=int, default=cfg.slab_depth,
+        help="Used with --nogui. Build the histogram by reading this many \
+        slices at a time instead of loading the whole image. Gives the same \
+        histogram with less memory. 0 (default) loads the whole image. \
+        Also sets the slabs of the threaded gradient magnitude (by default a \
+        few slabs per thread, at least 16 slices)."
+        )
     parser.add_argument(
         "--include_zeros", action='store_true',
         help="Include image zeros in histograms. Not used by default."
@@ -90,11 +114,75 @@ def main():
         "--export_gramag", action='store_true',
         help="Export the gradient magnitude image. Not used by default."
         )
+    parser.add_argument(
+        "--extra_features", metavar='path', nargs='+', required=False,
+        default=cfg.extra_features,
+        help="Paths to additional images with the same dimensions (eg. T2w, \
+        PDw). A sparse joint histogram of all images is computed."
+        )
+    parser.add_argument(
+        "--hist_axes", metavar=('x', 'y'), nargs=2, required=False, type=int,
+        default=cfg.hist_axes,
+        help="Images shown on the 2D histogram axes when extra features are \
+        used. 0 is the input image, 1 is the gradient magnitude and 2 and up \
+        are the extra features. Default is 0 1."
+        )
+    parser.add_argument(
+        "--label_names", metavar='name', nargs='+', required=False,
+        default=cfg.label_names,
+        help="Names of the labels that are added in the GUI, saved next to \
+        the exported labels."
+        )
     parser.add_argument(
         "--force_original_precision", action='store_true',
         help="Do not change the data type of the input image. Can be useful \
         for very large images. Off by default."
         )
+    parser.add_argument(
+        "--precision", metavar=cfg.dtype, required=False,
+        default=cfg.dtype, choices=['float32', 'float64'],
+        help="Floating point precision of the images and gradients during \
+        processing and export. float32 by default."
+        )
+    parser.add_argument(
+        "--mask", metavar='path', required=False, default=cfg.mask,
+        help="Path to a mask image (eg. brain mask) with the same dimensions. \
+        Only non-zero mask voxels are used in the histogram, the truncation \
+        percentiles and the exported labels."
+        )
+    parser.add_argument(
+        "--no_crop", action='store_true',
+        help="Do not crop the image to the bounding box of non-zero voxels. \
+        Cropping is only used when zeros are discarded. Off by default."
+        )
+    parser.add_argument(
+        "--compresslevel", metavar=str(cfg.compresslevel), required=False,
+        type=int, default=cfg.compresslevel, choices=range(10),
+        help="Gzip compression level of exported images, from 1 (fastest) to \
+        9 (smallest). 0 exports uncompressed .nii files. Default is 1."
+        )
+    parser.add_argument(
+        "--nr_threads", metavar=str(cfg.nr_threads), required=False,
+        type=int, default=cfg.nr_threads,
+        help="Number of threads used to compute gradient magnitudes and to \
+        compress exported images. 0 (default) uses all available cores."
+        )
+    parser.add_argument(
+        "--cache_dir", metavar='path', required=False,
+        default=cfg.cache_dir,
+        help="Directory where preprocessed images and histograms are cached \
+        to reopen the same image faster."
+        )
+    parser.add_argument(
+        "--cache_size", metavar=str(cfg.cache_size), required=False,
+        type=float, default=cfg.cache_size,
+        help="Maximum size of the cache directory in GB. Least recently used \
+        entries are removed."
+        )
+    parser.add_argument(
+        "--no_cache", action='store_true',
+        help="Do not read or write the cache. Off by default."
+        )
     parser.add_argument(
         "--matplotlib_backend", metavar=str(cfg.matplotlib_backend),
         default=cfg.matplotlib_backend, required=False,
@@ -135,6 +223,11 @@ def main():
 
     # set cfg file variables to be accessed from other scripts
     args = parser.parse_args()
+    nr_features = 2 + len(args.extra_features)
+    if any(axis < 0 or axis >= nr_features for axis in args.hist_axes):
+        parser.error("--hist_axes values must be from 0 to {} with {} extra "
+                     "features.".format(nr_features - 1,
+                                        len(args.extra_features)))
     # used in all
     cfg.filename = args.filename
     # used in segmentator GUI (main and ncut)
@@ -144,12 +237,25 @@ def main():
     cfg.perc_max = args.percmax
     cfg.valmin = args.valmin
     cfg.valmax = args.valmax
+    cfg.exact_percentiles = args.exact_percentiles
     cfg.cbar_max = args.cbar_max
     cfg.cbar_init = args.cbar_init
     if args.include_zeros:
         cfg.discard_zeros = False
     cfg.export_gramag = args.export_gramag
     cfg.force_original_precision = args.force_original_precision
+    cfg.dtype = args.precision
+    cfg.slab_depth = args.slab_depth
+    cfg.extra_features = args.extra_features
+    cfg.hist_axes = tuple(args.hist_axes)
+    cfg.label_names = args.label_names
+    cfg.mask = args.mask
+    cfg.no_crop = args.no_crop
+    cfg.compresslevel = args.compresslevel
+    cfg.nr_threads = args.nr_threads
+    cfg.cache_dir = args.cache_dir
+    cfg.cache_size = args.cache_size
+    cfg.no_cache = args.no_cache
     cfg.matplotlib_backend = args.matplotlib_backend
     # used in ncut preparation
     cfg.ncut_figs = args.ncut_figs
@@ -160,6 +266,8 @@ def main():
     cfg.ncut = args.ncut
     # used in deriche filter
     cfg.deriche_alpha = args.deriche_alpha
+    # used in gaussian gradient magnitude
+    cfg.gramag_sigma = args.gramag_sigma
 
     welcome_str = 'Segmentator {}'.format(__version__)
     welcome_decor = '=' * len(welcome_str)
@@ -4,6 +4,8 @@ Useful to hold command line arguments.
 
 """
 
+import os
+
 # Define variables used to initialise the sector mask
 init_centre = (0, 0)
 init_radius = 100
@@ -13,22 +15,38 @@ init_theta = (0, 360)
 filename = 'sample_filename_here'
 gramag = 'scharr'
 deriche_alpha = 3.0
+gramag_sigma = 1.0  # in the units of pixdim, often mm
 perc_min = 2.5
 perc_max = 97.5
 valmin = float('nan')
 valmax = float('nan')
+exact_percentiles = False
 scale = 400
 cbar_max = 5.0
 cbar_init = 3.0
 discard_zeros = True
 export_gramag = False
 force_original_precision = False
+dtype = 'float32'  # precision of the working arrays
+slab_depth = 0  # slices processed at once with --nogui, 0 loads all
+compresslevel = 1  # gzip level of exported images, 0 saves uncompressed
+nr_threads = 0  # 0 uses all available cores
+mask = None  # path to a foreground (eg. brain) mask
+no_crop = False
+crop_margin = 2  # voxels kept around the non-zero bounding box
+extra_features = []
+label_names = []
+hist_axes = (0, 1)
+cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'segmentator')
+cache_size = 4.0  # in GB, least recently used entries are removed
+no_cache = False
 
 # Change in case of glitches in the host operating system
 matplotlib_backend = 'tkagg'
 
 # Possible gradient magnitude computation keyword options
-gramag_options = ['scharr', 'sobel', 'prewitt', 'numpy', 'deriche']
+gramag_options = ['scharr', 'sobel', 'prewitt', 'numpy', 'deriche',
+                  'gaussian']
 
 # Used in segmentator ncut
 ncut = False
@@ -12,3 +12,8 @@ edge_thr = 0.001
 gamma = 1
 downsampling = 0
 no_nonpositive_mask = False
+dtype = 'float32'  # precision of the working arrays
+compresslevel = 1  # gzip level of exported images, 0 saves uncompressed
+nr_threads = 0  # 0 uses all available cores
+no_crop = False
+crop_margin = 2  # voxels kept around the positive bounding box
@@ -1,21 +1,114 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+# cython: cdivision=True, initializedcheck=False
 """3D Deriche filter implementation."""
 
 import numpy as np
-cimport numpy as np
-
-DTYPE = np.int
-ctypedef np.int_t DTYPE_t
-
-def deriche_3D(np.ndarray[float, mode="c", ndim=3] inputData, float alpha=1):
-    """Reference: Monga et al. 1991."""
-    # c definitions
-    cdef float s, a_0, a_1, a_2, a_3 , b_1, b_2
-    cdef np.ndarray[double, mode="c", ndim=3] S_p, S_n, R_p, R_n, T_p, T_n
-    cdef np.ndarray[double, mode="c", ndim=3] S, R, P
-    cdef int imax = inputData.shape[0]
-    cdef int jmax = inputData.shape[1]
-    cdef int kmax = inputData.shape[2]
-    cdef int i, j, k
+from cython.parallel cimport parallel, prange
+from libc.stdlib cimport malloc, free
+from libc.string cimport memset
+
+
+cdef void deriche_derivative_line(float* x, float* y, float* s_p, float* s_n,
+                                  Py_ssize_t n, float alpha, float b_1,
+                                  float b_2) noexcept nogil:
+    """Causal and anti-causal derivative recurrences of one scanline."""
+    cdef Py_ssize_t i
+    memset(s_p, 0, n * sizeof(float))
+    memset(s_n, 0, n * sizeof(float))
+    for i in range(3, n):
+        s_p[i] = x[i-1] - b_1*s_p[i-1] - b_2*s_p[i-2]
+    # The first anti-causal sample is computed before its neighbours, and
+    # the last two samples are left at zero
+    if n > 2:
+        s_n[0] = x[1]
+    for i in range(n-3, 0, -1):
+        s_n[i] = x[i+1] - b_1*s_n[i+1] - b_2*s_n[i+2]
+    for i in range(n):
+        y[i] = alpha*(s_p[i] - s_n[i])
+
+
+cdef void deriche_smooth_line(float* x, float* y, float* r_p, float* r_n,
+                              Py_ssize_t n, float a_0, float a_1, float a_2,
+                              float a_3, float b_1, float b_2) noexcept nogil:
+    """Causal and anti-causal smoothing recurrences of one scanline."""
+    cdef Py_ssize_t i
+    memset(r_p, 0, n * sizeof(float))
+    memset(r_n, 0, n * sizeof(float))
+    for i in range(3, n):
+        r_p[i] = a_0*x[i] + a_1*x[i-1] - b_1*r_p[i-1] - b_2*r_p[i-2]
+    if n > 2:
+        r_n[0] = a_2*x[1] + a_3*x[2]
+    for i in range(n-3, 0, -1):
+        r_n[i] = a_2*x[i+1] + a_3*x[i+2] - b_1*r_n[i+1] - b_2*r_n[i+2]
+    for i in range(n):
+        y[i] = r_p[i] + r_n[i]
+
+
+cdef void deriche_axis(float[:, :, ::1] src, float[:, :, ::1] dst, int axis,
+                       bint derivative, float[::1] coef,
+                       int nr_threads) noexcept:
+    """Filter all scanlines of src along one axis and write them to dst.
+
+    src and dst can be the same volume, since every scanline is copied to a
+    per-thread buffer before it is filtered.
+    """
+    cdef Py_ssize_t n = src.shape[axis]
+    cdef Py_ssize_t n_1 = src.shape[(axis + 1) % 3]
+    cdef Py_ssize_t n_2 = src.shape[(axis + 2) % 3]
+    cdef Py_ssize_t stride = src.strides[axis] // sizeof(float)
+    cdef Py_ssize_t stride_1 = src.strides[(axis + 1) % 3] // sizeof(float)
+    cdef Py_ssize_t stride_2 = src.strides[(axis + 2) % 3] // sizeof(float)
+    cdef float* src_ptr = &src[0, 0, 0]
+    cdef float* dst_ptr = &dst[0, 0, 0]
+    cdef float* buffers = NULL  # private, allocated by each thread
+    cdef Py_ssize_t line, offset, i
+
+    with nogil, parallel(num_threads=nr_threads):
+        buffers = <float*> malloc(4 * n * sizeof(float))
+        for line in prange(n_1 * n_2, schedule='static'):
+            offset = (line // n_2) * stride_1 + (line % n_2) * stride_2
+            for i in range(n):
+                buffers[i] = src_ptr[offset + i*stride]
+            if derivative:
+                deriche_derivative_line(
+                    buffers, buffers + n, buffers + 2*n, buffers + 3*n, n,
+                    coef[0], coef[5], coef[6])
+            else:
+                deriche_smooth_line(
+                    buffers, buffers + n, buffers + 2*n, buffers + 3*n, n,
+                    coef[1], coef[2], coef[3], coef[4], coef[5], coef[6])
+            for i in range(n):
+                dst_ptr[offset + i*stride] = buffers[n + i]
+        free(buffers)
+
+
+def deriche_3D(inputData, float alpha=1, int nr_threads=1):
+    """Reference: Monga et al. 1991.
+
+    Parameters
+    ----------
+    inputData : np.ndarray, 3D
+        Image, converted to C contiguous float32 if needed.
+    alpha : float
+        Deriche filter parameter.
+    nr_threads : int
+        Number of threads used to filter the scanlines.
+
+    Returns
+    -------
+    gradients : np.ndarray, float32, 4D
+        Derivatives along the first, second and third axes stacked on the
+        first dimension. Each derivative is smoothed along the two other
+        axes in cyclic order.
+
+    """
+    cdef float[:, :, ::1] image = np.ascontiguousarray(inputData,
+                                                       dtype=np.float32)
+    gradients = np.zeros((3,) + tuple(inputData.shape), dtype=np.float32)
+    if gradients.size == 0:
+        return gradients
+    cdef float[:, :, :, ::1] out = gradients
+    cdef int axis
 
     # constants
     s = np.power((1 - np.exp(-alpha)), 2) / \
@@ -26,52 +119,14 @@ def deriche_3D(np.ndarray[float, mode="c", ndim=3] inputData, float alpha=1):
     b_2 = np.exp(-2 * alpha)
     a_2 = a_1 - s * b_1
     a_3 = -s * b_2
+    cdef float[::1] coef = np.array([alpha, a_0, a_1, a_2, a_3, b_1, b_2],
+                                    dtype=np.float32)
 
     # Recursive filter implementation
-    S_p = np.zeros((imax, jmax, kmax))
-    S_n = np.zeros((imax, jmax, kmax))
-    for k in range(kmax):
-        for j in range(jmax):
-            for i in range(0, imax):
-                if i > 2:
-                    S_p[i, j, k] = inputData[i-1, j, k] \
-                                   - b_1*S_p[i-1, j, k] \
-                                   - b_2*S_p[i-2, j, k]
-                i = i*-1 % inputData.shape[0]  # inverse index
-                if i < inputData.shape[0]-2:
-                    S_n[i, j, k] = inputData[i+1, j, k] \
-                                   - b_1*S_n[i+1, j, k] \
-                                   - b_2*S_n[i+2, j, k]
-
-    S = alpha*(S_p - S_n)
-
-    R_p = np.zeros((imax, jmax, kmax))
-    R_n = np.zeros((imax, jmax, kmax))
-    for k in range(kmax):
-        for i in range(imax):
-            for j in range(0, jmax):
-                if j > 2:
-                    R_p[i, j, k] = a_0*S[i, j, k] + a_1*S[i, j-1, k] \
-                                   - b_1*R_p[i, j-1, k] - b_2*R_p[i, j-2, k]
-                j = j*-1 % inputData.shape[1]  # inverse index
-                if j < inputData.shape[1]-2:
-                    R_n[i, j, k] = a_2*S[i, j+1, k] + a_3*S[i, j+2, k] \
-                                   - b_1*R_n[i, j+1, k] - b_2*R_n[i, j+2, k]
-
-    R = R_n + R_p
-
-    T_p = np.zeros((imax, jmax, kmax))
-    T_n = np.zeros((imax, jmax, kmax))
-    for i in range(imax):
-        for j in range(jmax):
-            for k in range(0, kmax):
-                if k > 2:
-                    T_p[i, j, k] = a_0*R[i, j, k] + a_1*R[i, j, k-1] \
-                                 - b_1*T_p[i, j, k-1] - b_2*T_p[i, j, k-2]
-                k = k*-1 % inputData.shape[2]  # inverse index
-                if k < inputData.shape[2]-2:
-                    T_n[i, j, k] = a_2*R[i, j, k+1] + a_3*R[i, j, k+2] \
-                                   - b_1*T_n[i, j, k+1] - b_2*T_n[i, j, k+2]
-
-    T = T_n + T_p
-    return T
+    for axis in range(3):
+        deriche_axis(image, out[axis], axis, True, coef, nr_threads)
+        deriche_axis(out[axis], out[axis], (axis + 1) % 3, False, coef,
+                     nr_threads)
+        deriche_axis(out[axis], out[axis], (axis + 2) % 3, False, coef,
+                     nr_threads)
+    return gradients
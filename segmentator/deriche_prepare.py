@@ -3,36 +3,141 @@
 You can use --graMag flag to pass resulting nifti files from this script.
 """
 
-from segmentator.deriche_3D import deriche_3D
+from multiprocessing import cpu_count
+from concurrent.futures import ThreadPoolExecutor
+from scipy.signal import lfilter
 import numpy as np
 
+try:
+    from segmentator.deriche_3D import deriche_3D
+except ImportError:  # extension is not compiled
+    deriche_3D = None
+
+
+def deriche_coefficients(alpha):
+    """Deriche filter coefficients (a_0, a_1, a_2, a_3, b_1, b_2)."""
+    s = np.power((1 - np.exp(-alpha)), 2) / \
+        (1 + 2 * alpha * np.exp(-alpha) - np.exp(-2*alpha))
+    a_0 = s
+    a_1 = s * (alpha - 1) * np.exp(-alpha)
+    b_1 = -2 * np.exp(-alpha)
+    b_2 = np.exp(-2 * alpha)
+    a_2 = a_1 - s * b_1
+    a_3 = -s * b_2
+    return a_0, a_1, a_2, a_3, b_1, b_2
+
+
+def deriche_axis(data, axis, alpha, derivative=False):
+    """Apply the Deriche recurrences to all scanlines along one axis.
+
+    Vectorized equivalent of the scanline loops of the deriche_3D
+    extension, including their boundary handling: the first three causal
+    samples and the last two anti-causal samples are zero, and the first
+    anti-causal sample ignores its neighbours.
+
+    Parameters
+    ----------
+    data : np.ndarray, float32
+        Image.
+    axis : int
+        Filtering axis.
+    alpha : float
+        Deriche filter parameter.
+    derivative : bool
+        Apply the derivative recurrences instead of the smoothing ones.
+
+    Returns
+    -------
+    out : np.ndarray, float32
+        Filtered image.
+
+    """
+    a_0, a_1, a_2, a_3, b_1, b_2 = np.float32(deriche_coefficients(alpha))
+    num = np.ones(1, dtype=np.float32)
+    den = np.array([1, b_1, b_2], dtype=np.float32)
+    # scanlines are made contiguous, lfilter is much faster on those
+    data = np.ascontiguousarray(np.moveaxis(data, axis, -1), dtype=np.float32)
+    n = data.shape[-1]
+    if n < 3:
+        return np.zeros(np.moveaxis(data, -1, axis).shape, dtype=np.float32)
+    # causal part, input samples of the recurrence
+    inp = np.zeros(data.shape, dtype=np.float32)
+    if derivative:
+        inp[..., 3:] = data[..., 2:-1]
+    else:
+        inp[..., 3:] = a_0 * data[..., 3:] + a_1 * data[..., 2:-1]
+    out = lfilter(num, den, inp, axis=-1)
+    # anti-causal part, filtered in reversed order
+    inp[...] = 0
+    if derivative:
+        inp[..., 1:-2] = data[..., 2:-1]
+        first = data[..., 1]
+    else:
+        inp[..., 1:-2] = a_2 * data[..., 2:-1] + a_3 * data[..., 3:]
+        first = a_2 * data[..., 1] + a_3 * data[..., 2]
+    neg = lfilter(num, den, inp[..., ::-1], axis=-1)[..., ::-1]
+    neg[..., 0] = first
+    if derivative:
+        out -= neg
+        out *= alpha
+    else:
+        out += neg
+    return np.moveaxis(out, -1, axis)
+
+
+def deriche_3D_lfilter(inputData, alpha=1, nr_threads=1):
+    """Pure NumPy and SciPy version of the deriche_3D extension.
+
+    Parameters
+    ----------
+    inputData : np.ndarray, 3D
+        Image.
+    alpha : float
+        Deriche filter parameter.
+    nr_threads : int
+        Number of threads, the three derivatives are computed concurrently.
+
+    Returns
+    -------
+    gradients : np.ndarray, float32, 4D
+        Derivatives along the first, second and third axes stacked on the
+        first dimension. Each derivative is smoothed along the two other
+        axes in cyclic order.
+
+    """
+    image = np.asarray(inputData, dtype=np.float32)
+    alpha = np.float32(alpha)
+
+    def derivative(axis):
+        out = deriche_axis(image, axis, alpha, derivative=True)
+        out = deriche_axis(out, (axis + 1) % 3, alpha)
+        return deriche_axis(out, (axis + 2) % 3, alpha)
+
+    with ThreadPoolExecutor(max(min(nr_threads, 3), 1)) as pool:
+        return np.array(list(pool.map(derivative, range(3))),
+                        dtype=np.float32)
+
 
 def Deriche_Gradient_Magnitude(image, alpha, normalize=False,
-                               return_gradients=False):
+                               return_gradients=False, nr_threads=0):
     """Compute Deriche gradient magnitude of a volumetric image."""
-    # calculate gradients
-    image = np.ascontiguousarray(image, dtype=np.float32)
-    gra_x = deriche_3D(image, alpha=alpha)
-    image = np.transpose(image, (2, 0, 1))
+    # calculate gradients along x, y and z on the original layout
     image = np.ascontiguousarray(image, dtype=np.float32)
-    gra_y = deriche_3D(image, alpha=alpha)
-    gra_y = np.transpose(gra_y, (1, 2, 0))
-    image = np.transpose(image, (2, 0, 1))
-    image = np.ascontiguousarray(image, dtype=np.float32)
-    gra_z = deriche_3D(image, alpha=alpha)
-    gra_z = np.transpose(gra_z, (2, 0, 1))
-
-    # Put the image gradients in 4D format
-    gradients = np.array([gra_x, gra_y, gra_z])
-    gradients = np.transpose(gradients, (1, 2, 3, 0))
+    nr_threads = nr_threads if nr_threads > 0 else cpu_count()
+    if deriche_3D is None:
+        print('    Deriche extension is not compiled, using SciPy filters.')
+        gra_x, gra_y, gra_z = deriche_3D_lfilter(image, alpha=alpha,
+                                                 nr_threads=nr_threads)
+    else:
+        gra_x, gra_y, gra_z = deriche_3D(image, alpha=alpha,
+                                         nr_threads=nr_threads)
 
-    if return_gradients:
-        return gradients
+    if return_gradients:  # Put the image gradients in 4D format
+        return np.stack([gra_x, gra_y, gra_z], axis=-1)
 
     else:  # Deriche gradient magnitude
-        gra_mag = np.sqrt(np.power(gradients[:, :, :, 0], 2.0) +
-                          np.power(gradients[:, :, :, 1], 2.0) +
-                          np.power(gradients[:, :, :, 2], 2.0))
+        gra_mag = np.sqrt(np.power(gra_x, 2.0) + np.power(gra_y, 2.0) +
+                          np.power(gra_z, 2.0))
         if normalize:
             min_ima, max_ima = np.percentile(image, [0, 100])
             min_der, max_der = np.percentile(gra_mag, [0, 100])
@@ -5,7 +5,7 @@ from __future__ import division
 import os
 import numpy as np
 import segmentator.config_filters as cfg
-from nibabel import load, Nifti1Image, save
+from nibabel import Nifti1Image
 from numpy.linalg import eigh
 from scipy.ndimage import gaussian_filter
 from time import time
@@ -13,13 +13,20 @@ from segmentator.filters_utils import (
     self_outer_product, dot_product_matrix_vector, divergence,
     compute_diffusion_weights, construct_diffusion_tensors,
     smooth_matrix_image)
+from segmentator.io_utils import load_nifti, load_data
+from segmentator.io_utils import save_nifti, get_nifti_ext
+from segmentator.utils import find_crop, uncrop
 from scipy.ndimage.interpolation import zoom
 
 
-def QC_export(image, basename, identifier, nii):
+def QC_export(image, basename, identifier, nii, crop=None, full_ima=None):
     """Quality control exports."""
+    if crop is not None:  # put back into the input image
+        image = uncrop(image, crop, full_ima.shape, background=full_ima)
     out = Nifti1Image(image, affine=nii.affine, header=nii.header)
-    save(out, '{}_{}.nii.gz'.format(basename, identifier))
+    save_nifti(out, basename + '_' + identifier +
+               get_nifti_ext(cfg.compresslevel),
+               cfg.compresslevel, cfg.nr_threads)
 
 
 # Input
@@ -43,10 +50,25 @@ identifier = MODE
 
 # Load data
 basename = file_name.split(os.extsep, 1)[0]
-nii = load(file_name)
+nii = load_nifti(file_name)
 vres = nii.header['pixdim'][1:4]  # voxel resolution x y z
 norm_vres = [r/min(vres) for r in vres]  # normalized voxel resolutions
-ima = (nii.get_fdata()).astype('float32')
+ima, full_dims = load_data(nii, dtype=cfg.dtype)
+
+crop, full_ima = None, ima
+if not cfg.no_crop and not cfg.no_nonpositive_mask and cfg.downsampling <= 1:
+    # only masked voxels and their neighbours within the smoothing kernels
+    # change, margin covers both gaussian kernels (truncated at 4 sigma)
+    margin = cfg.crop_margin + int(np.ceil(4 * SIGMA) + np.ceil(4 * RHO))
+    crop = find_crop(np.maximum(ima, 0), margin=margin)
+    # zero padded smoothing at the box edges is only exact if the image is
+    # zero outside of the box
+    if np.count_nonzero(ima[crop]) == np.count_nonzero(ima):
+        ima = np.ascontiguousarray(ima[crop])
+        print('  Cropped to positive voxels: {} -> {}'.format(
+            full_dims, ima.shape))
+    else:
+        crop = None
 
 if cfg.downsampling > 1:  # TODO: work in progress
     print('  Applying initial downsampling...')
@@ -103,7 +125,7 @@ for t in range(NR_ITER):
     eigvecs, eigvals, mu = None, None, None
 
     # Reshape processed voxels (not masked) back to image space
-    temp = np.zeros([np.prod(dims), 3, 3])
+    temp = np.zeros([np.prod(dims), 3, 3], dtype=cfg.dtype)
     temp[idx_msk_flat, :, :] = difft
     difft = temp.reshape(dims + (3, 3))
     temp = None
@@ -121,7 +143,7 @@ for t in range(NR_ITER):
 
     # Convenient exports for intermediate outputs
     if (t+1) % SAVE_EVERY == 0 and (t+1) != NR_ITER:
-        QC_export(ima, basename, params, nii)
+        QC_export(ima, basename, params, nii, crop, full_ima)
         duration = time() - start
         mins, secs = int(duration / 60), int(duration % 60)
         print('  Image saved (took {} min {} sec)'.format(mins, secs))
@@ -130,13 +152,13 @@ if cfg.downsampling > 1:  # TODO: work in progress
     print('  Final upsampling...')
     residual = ima - orig
     residual = zoom(residual, cfg.downsampling)
-    ima = (nii.get_fdata()).astype('float32') + residual
+    ima = load_data(nii, dtype=cfg.dtype)[0] + residual
 else:
     pass
 
 
 print('Saving final image...')
-QC_export(ima, basename, params, nii)
+QC_export(ima, basename, params, nii, crop, full_ima)
 
 duration = time() - start
 mins, secs = int(duration / 60), int(duration % 60)
@@ -77,6 +77,29 @@ def main():
         "--no_nonpositive_mask", action='store_true',
         help="(!WIP!) Do not mask out non-positive values."
         )
+    parser.add_argument(
+        "--precision", metavar=cfg.dtype, required=False,
+        default=cfg.dtype, choices=['float32', 'float64'],
+        help="Floating point precision of the images and tensors. float32 by \
+        default."
+        )
+    parser.add_argument(
+        "--no_crop", action='store_true',
+        help="Do not crop the image to the bounding box of positive voxels. \
+        Off by default."
+        )
+    parser.add_argument(
+        "--compresslevel", metavar=str(cfg.compresslevel), required=False,
+        type=int, default=cfg.compresslevel, choices=range(10),
+        help="Gzip compression level of exported images, from 1 (fastest) to \
+        9 (smallest). 0 exports uncompressed .nii files. Default is 1."
+        )
+    parser.add_argument(
+        "--nr_threads", metavar=str(cfg.nr_threads), required=False,
+        type=int, default=cfg.nr_threads,
+        help="Number of threads used to compress exported images. 0 \
+        (default) uses all available cores."
+        )
 
     # set cfg file variables to be accessed from other scripts
     args = parser.parse_args()
@@ -90,6 +113,10 @@ def main():
     cfg.save_every = args.save_every
     cfg.downsampling = args.downsampling
     cfg.no_nonpositive_mask = args.no_nonpositive_mask
+    cfg.dtype = args.precision
+    cfg.no_crop = args.no_crop
+    cfg.compresslevel = args.compresslevel
+    cfg.nr_threads = args.nr_threads
 
     welcome_str = 'Segmentator {}'.format(__version__)
     welcome_decor = '=' * len(welcome_str)
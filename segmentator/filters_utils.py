@@ -39,7 +39,7 @@ def dot_product_matrix_vector(matrix_field, vector_field):
 def divergence(vector_field):
     """Vectorized computation of divergence, also called Laplacian."""
     dims = vector_field.shape
-    result = np.zeros(dims[:-1])
+    result = np.zeros(dims[:-1], dtype=vector_field.dtype)
     for i in range(dims[-1]):
         result += np.gradient(vector_field[..., i], axis=i)
     return result
@@ -61,7 +61,7 @@ def compute_diffusion_weights(eigvals, mode, LAMBDA=0.001, ALPHA=0.001, M=4):
     if mode in ['EED', 'cEED', 'iEED']:  # TODO: I might remove these.
 
         if mode == 'EED':  # edge enhancing diffusion
-            mu = np.ones(eigvals.shape)
+            mu = np.ones(eigvals.shape, dtype=eigvals.dtype)
             term1 = LAMBDA
             term2 = eigvals[idx_pos_e2, 1:] - eigvals[idx_pos_e2, 0, None]
             mu[idx_pos_e2, 1:] = 1. - c * np.exp(-(term1/term2)**M)
@@ -76,25 +76,25 @@ def compute_diffusion_weights(eigvals, mode, LAMBDA=0.001, ALPHA=0.001, M=4):
     elif mode in ['CED', 'cCED']:
 
         if mode == 'CED':  # coherence enhancing diffusion (FIXME: not tested)
-            mu = np.ones(eigvals.shape) * ALPHA
+            mu = np.ones(eigvals.shape, dtype=eigvals.dtype) * ALPHA
             term1 = LAMBDA
             term2 = eigvals[:, 2, None] - eigvals[:, :-1]
             mu[:, :-1] = ALPHA + c * np.exp(-(term1/term2)**M)
 
         elif mode == 'cCED':  # conservative coherence enhancing diffusion
-            mu = np.ones(eigvals.shape) * ALPHA
+            mu = np.ones(eigvals.shape, dtype=eigvals.dtype) * ALPHA
             term1 = LAMBDA + eigvals[:, 0:2]
             term2 = eigvals[:, 2, None] - eigvals[:, 0:2]
             mu[:, 0:2] = ALPHA + c * np.exp(-(term1/term2)**M)
 
     elif mode == 'CURED':  # NOTE: Somewhat experimental
         import compoda.core as coda
-        mu = np.ones(eigvals.shape)
+        mu = np.ones(eigvals.shape, dtype=eigvals.dtype)
         mu[idx_pos_e2, :] = 1. - coda.closure(eigvals[idx_pos_e2, :])
 
     elif mode == 'STEDI':  # NOTE: Somewhat more experimental
         import compoda.core as coda
-        mu = np.ones(eigvals.shape)
+        mu = np.ones(eigvals.shape, dtype=eigvals.dtype)
         eigs = eigvals[idx_pos_e2, :]
         term1 = coda.closure(eigs)
         term2 = np.abs((np.max(term1, axis=-1) - np.min(term1, axis=-1)) - 0.5)
@@ -102,7 +102,7 @@ def compute_diffusion_weights(eigvals, mode, LAMBDA=0.001, ALPHA=0.001, M=4):
         mu[idx_pos_e2, :] = np.abs(term2[:, None] - term1)
 
     else:
-        mu = np.ones(eigvals.shape)
+        mu = np.ones(eigvals.shape, dtype=eigvals.dtype)
         print('    Invalid smoothing mesthod. Weights are all set to ones.')
 
     return mu
@@ -111,7 +111,7 @@ def compute_diffusion_weights(eigvals, mode, LAMBDA=0.001, ALPHA=0.001, M=4):
 def construct_diffusion_tensors(eigvecs, weights):
     """Vectorized consruction of diffusion tensors."""
     dims = eigvecs.shape
-    D = np.zeros(dims[:-2] + (dims[-1], dims[-1]))
+    D = np.zeros(dims[:-2] + (dims[-1], dims[-1]), dtype=eigvecs.dtype)
     for i in range(dims[-1]):  # weight vectors
         D += weights[:, i, None, None] * self_outer_product(eigvecs[..., i])
     return D
@@ -6,11 +6,47 @@ import os
 import numpy as np
 import matplotlib.pyplot as plt
 import segmentator.config as cfg
-from segmentator.utils import map_2D_hist_to_ima
-from nibabel import save, Nifti1Image
+from matplotlib.colors import LogNorm
+from segmentator.utils import create_2D_hist_index
+from segmentator.utils import prep_2D_hist_foreground
+from segmentator.utils import prep_percentile_sketch, sketch_percentile
+from segmentator.utils import sketch_range, truncate_scale_range
+from segmentator.utils import map_2D_hist_to_ima_indexed, get_pixel_voxels
+from segmentator.utils import prep_2D_hist_moments, selection_stats
+from segmentator.utils import uncrop, relabel, get_label_dtype
+from segmentator.utils import set_gradient_magnitude
+from segmentator.utils import find_foreground, load_mask, load_extra_features
+from segmentator.io_utils import save_nifti, get_nifti_ext, load_data
+from nibabel import Nifti1Image
 from scipy.ndimage.morphology import binary_erosion
 
 
+def plot_2D_hist(ax, counts, bin_edges, cmap='Greys'):
+    """Plot 2D histogram counts (similar to plt.hist2d).
+
+    Parameters
+    ----------
+    ax : matplotlib.axes.Axes
+        Axes to plot the histogram in.
+    counts : np.ndarray, shape(nr_bins, nr_bins)
+        2D histogram counts, see utils.prep_2D_hist.
+    bin_edges : np.ndarray
+        Edges of the one dimensional bins.
+    cmap : string
+        Colormap.
+
+    Returns
+    -------
+    volHistH : matplotlib.collections.QuadMesh
+        Handle of the histogram plot.
+
+    """
+    volHistH = ax.pcolormesh(bin_edges, bin_edges, counts.T, cmap=cmap)
+    ax.set_xlim(bin_edges[0], bin_edges[-1])
+    ax.set_ylim(bin_edges[0], bin_edges[-1])
+    return volHistH
+
+
 class responsiveObj:
     """Stuff to interact in the user interface."""
 
@@ -31,6 +67,21 @@ class responsiveObj:
         self.cycleCount = 0
         self.cycRotHistory = [[0, 0], [0, 0], [0, 0]]
         self.highlights = [[], []]  # to hold image to histogram circles
+        self.slcIdxKey = None  # to hold which slice is indexed
+        self.slcLut = None  # to hold the last mapped volume histogram mask
+        # input image before truncation and scaling, for changing the range
+        # (None is read from the file when needed)
+        self.origRaw = kwargs.get('origRaw')
+        self.sketch, self.mask = None, None
+        self.rangePending = False  # slider changes applied on release
+        self.voxVol = np.prod(self.nii.header.get_zooms()[:3])  # in mm^3
+        self.labelMap = None  # to hold the added labels (main mode)
+        self.labelNames = []
+        # bounding box of the loaded image in the input image, see find_crop
+        self.crop = kwargs.get('crop')
+        self.fullDims = kwargs.get('fullDims')
+        # flat indices of the histogram voxels, see find_foreground
+        self.fgIdx = kwargs.get('fgIdx')
 
     def remapMsks(self, remap_slice=True):
         """Update volume histogram to image mapping.
@@ -42,34 +93,128 @@ class responsiveObj:
 
         """
         if self.segmType == 'main':
-            self.volHistMask = self.sectorObj.binaryMask()
-            self.volHistMask = self.lassoArr(self.volHistMask, self.idxLasso)
+            active = self.sectorObj.binaryMask()
+            active = self.lassoArr(active, self.idxLasso)
+            self.volHistMask = self.compositeLabels(active)
             self.volHistMaskH.set_data(self.volHistMask)
+            self.updateSelectionStats()
         elif self.segmType == 'ncut':
             self.labelContours()
             self.volHistMaskH.set_data(self.volHistMask)
             self.volHistMaskH.set_extent((0, self.nrBins, self.nrBins, 0))
         # histogram to image mapping
         if remap_slice:
-            temp_slice = self.invHistVolume[:, :, self.sliceNr]
             image_slice_shape = self.invHistVolume[:, :, self.sliceNr].shape
-            if cfg.discard_zeros:
-                zmask = temp_slice != 0
-                image_slice_mask = map_2D_hist_to_ima(temp_slice[zmask],
-                                                      self.volHistMask)
-                # reshape to image slice shape
-                self.imaSlcMsk = np.zeros(image_slice_shape)
-                self.imaSlcMsk[zmask] = image_slice_mask
-            else:
-                image_slice_mask = map_2D_hist_to_ima(temp_slice.flatten(),
-                                                      self.volHistMask)
-                # reshape to image slice shape
-                self.imaSlcMsk = image_slice_mask.reshape(image_slice_shape)
+            slcIdx, slcPtr = self.getSlcIdx()
+            lut = self.getVolHistLut(self.volHistMask)
+            if self.slcLut is None or self.slcLut.size != lut.size:
+                self.slcLabels = map_2D_hist_to_ima_indexed(
+                    slcIdx, slcPtr, lut, np.prod(image_slice_shape))
+            else:  # only update voxels of the pixels that have changed
+                pixels = np.flatnonzero(lut != self.slcLut)
+                voxels, nr_voxels = get_pixel_voxels(slcIdx, slcPtr, pixels)
+                self.slcLabels[voxels] = np.repeat(lut[pixels], nr_voxels)
+            self.slcLut = np.copy(lut)
+            # reshape to image slice shape
+            self.imaSlcMsk = self.slcLabels.reshape(image_slice_shape)
 
             # for optional border visualization
             if self.borderSwitch == 1:
                 self.imaSlcMsk = self.calcImaMaskBrd()
 
+    def getSlcIdx(self):
+        """Get volume histogram index of the displayed slice."""
+        # index is built only once for every displayed slice
+        slcIdxKey = (self.cycleCount, self.sliceNr)
+        if self.slcIdxKey != slcIdxKey:
+            self.slcIdx = create_2D_hist_index(
+                self.invHistVolume[:, :, self.sliceNr], self.nrBins)
+            self.slcIdxKey = slcIdxKey
+            self.slcLut = None  # slice labels need to be mapped again
+        return self.slcIdx
+
+    def compositeLabels(self, active):
+        """Composite the active region with the added labels.
+
+        Parameters
+        ----------
+        active : np.ndarray, shape(nr_bins, nr_bins)
+            Boolean volume histogram mask of the sector and the lasso.
+
+        Returns
+        -------
+        volHistMask : np.ndarray, shape(nr_bins, nr_bins)
+            Integer label map. Pixels of added labels keep their label, the
+            active region gets the next label only in the unlabeled pixels.
+
+        """
+        if self.labelMap is None or self.labelMap.shape != active.shape:
+            self.labelMap = np.zeros(active.shape, dtype=int)
+        activeLabel = len(self.labelNames) + 1
+        volHistMask = np.copy(self.labelMap)
+        volHistMask[active & (self.labelMap == 0)] = activeLabel
+        return volHistMask
+
+    def addLabel(self, event):
+        """Keep the active region as a label and start a new region."""
+        if self.segmType != 'main':
+            return
+        self.labelMap = np.copy(self.volHistMask)
+        self.labelNames.append(self.getLabelName(len(self.labelNames) + 1))
+        print('  Label {} ({}) is added.'.format(len(self.labelNames),
+                                                 self.labelNames[-1]))
+        # new region starts from the sector only
+        self.idxLasso = np.zeros(self.nrBins*self.nrBins, dtype=bool)
+        self.updateLabelClim()
+        self.remapMsks()
+        self.updatePanels(update_slice=False, update_rotation=True,
+                          update_extent=False)
+
+    def getLabelName(self, label):
+        """Get label name from the command line or a default one."""
+        if label <= len(cfg.label_names):
+            return cfg.label_names[label - 1]
+        return 'label_{}'.format(label)
+
+    def clearLabels(self):
+        """Remove the added labels."""
+        self.labelMap = None
+        self.labelNames = []
+        self.updateLabelClim()
+
+    def updateLabelClim(self):
+        """Adjust mask color limits to the number of labels."""
+        vmax = len(self.labelNames) + 1  # active region is the last label
+        self.volHistMaskH.set_clim(0.1, vmax)
+        self.imaSlcMskH.set_clim(0.1, vmax)
+
+    def updateSelectionStats(self):
+        """Show statistics of the selected voxels using histogram counts."""
+        activeLabel = len(self.labelNames) + 1
+        selection = self.getVolHistLut(self.volHistMask) == activeLabel
+        nr_vox, mean_ima, mean_gra = selection_stats(self.volHistMoments,
+                                                     selection)
+        if tuple(cfg.hist_axes) == (0, 1):
+            # scaled values back to original range (same as axis labels)
+            unit = (self.pMax - self.pMin) / self.scale
+            mean_ima, mean_gra = self.pMin + mean_ima * unit, mean_gra * unit
+            names = 'intensity', 'gradient'
+        else:  # extra features are shown in histogram units
+            names = self.axes.get_xlabel(), self.axes.get_ylabel()
+        self.statsH.set_text(
+            'Selected: {} voxels, {:.1f} mm$^3$\n'
+            'Mean {}: {:.2f}, mean {}: {:.2f}'.format(
+                nr_vox, nr_vox * self.voxVol, names[0], mean_ima, names[1],
+                mean_gra))
+
+    def getVolHistLut(self, volHistMask):
+        """Get flat volume histogram mask to be mapped to image voxels."""
+        lut = np.ravel(volHistMask)
+        if cfg.discard_zeros:  # do not map voxels in the first pixel
+            lut = np.copy(lut)
+            lut[0] = 0
+        return lut
+
     def updatePanels(self, update_slice=True, update_rotation=False,
                      update_extent=False):
         """Update histogram and image panels."""
@@ -297,6 +442,8 @@ class responsiveObj:
     def on_release(self, event):
         """Determine what happens if mouse button is released."""
         self.press = None
+        if self.rangePending:  # range sliders were dragged
+            self.rebin()
         # Remove highlight circle
         if self.highlights[1]:
             self.highlights[1][-1].set_visible(False)
@@ -311,7 +458,7 @@ class responsiveObj:
     def updateColorBar(self, val):
         """Update slider for scaling log colorbar in 2D hist."""
         histVMax = np.power(10, self.sHistC.val)
-        plt.clim(vmax=histVMax)
+        self.volHistH.set_clim(vmax=histVMax)
 
     def updateSliceNr(self):
         """Update slice number and the selected slice."""
@@ -377,35 +524,39 @@ class responsiveObj:
         cycBackPerm = (self.cycleCount, (self.cycleCount+1) % 3,
                        (self.cycleCount+2) % 3)
         # assing unique integers (for ncut labels)
-        out_volHistMask = np.copy(self.volHistMask)
-        labels = np.unique(self.volHistMask)
-        intLabels = [i for i in range(labels.size)]
-        for label, newLabel in zip(labels, intLabels):
-            out_volHistMask[out_volHistMask == label] = intLabels[newLabel]
+        out_volHistMask = self.volHistMask
+        if self.segmType == 'ncut':  # main mode labels are kept as they are
+            out_volHistMask = relabel(self.volHistMask)
+        lut = self.getVolHistLut(out_volHistMask)
         # get 3D brain mask
-        volume_image = np.transpose(self.invHistVolume, cycBackPerm)
-        if cfg.discard_zeros:
-            zmask = volume_image != 0
-            temp_labeled_image = map_2D_hist_to_ima(volume_image[zmask],
-                                                    out_volHistMask)
-            out_nii = np.zeros(volume_image.shape)
-            out_nii[zmask] = temp_labeled_image  # put back flat labels
-        else:
-            out_nii = map_2D_hist_to_ima(volume_image.flatten(),
-                                         out_volHistMask)
-            out_nii = out_nii.reshape(volume_image.shape)
+        volume_shape = np.transpose(self.invHistVolume, cycBackPerm).shape
+        out_nii = map_2D_hist_to_ima_indexed(
+            self.pix2voxIdx, self.pix2voxPtr, lut, np.prod(volume_shape),
+            dtype=get_label_dtype(lut.max()))
+        out_nii = out_nii.reshape(volume_shape)
+        if self.crop is not None:  # pad back to the input image grid
+            out_nii = uncrop(out_nii, self.crop, self.fullDims)
         # save mask image as nii
         new_image = Nifti1Image(out_nii, header=self.nii.header,
                                 affine=self.nii.affine)
+        new_image.header.set_data_dtype(out_nii.dtype)  # not the input type
         # get new flex file name and check for overwriting
-        labels_out = '{}_labels_{}.nii.gz'.format(
-            self.basename, self.nrExports)
+        ext = get_nifti_ext(cfg.compresslevel)
+        labels_out = '{}_labels_{}{}'.format(
+            self.basename, self.nrExports, ext)
         while os.path.isfile(labels_out):
             self.nrExports += 1
-            labels_out = '{}_labels_{}.nii.gz'.format(
-                self.basename, self.nrExports)
-        save(new_image, labels_out)
+            labels_out = '{}_labels_{}{}'.format(
+                self.basename, self.nrExports, ext)
+        save_nifti(new_image, labels_out, cfg.compresslevel, cfg.nr_threads)
         print("    Saved as: {}".format(labels_out))
+        if self.labelNames:  # label names of all labels in the same volume
+            lut_out = labels_out[:-len(ext)] + '_lut.txt'
+            nrLabels = len(self.labelNames) + 1  # including active region
+            with open(lut_out, 'w') as f:
+                for label in range(1, nrLabels + 1):
+                    f.write('{} {}\n'.format(label, self.getLabelName(label)))
+            print("    Label names saved as: {}".format(lut_out))
 
     def clearOverlays(self):
         """Clear overlaid items such as circle highlights."""
@@ -426,6 +577,8 @@ class responsiveObj:
             if self.lassoSwitchCount == 1:  # reset only lasso drawing
                 self.idxLasso = np.zeros(self.nrBins*self.nrBins, dtype=bool)
             else:
+                # remove added labels
+                self.clearLabels()
                 # reset theta sliders
                 self.sThetaMin.reset()
                 self.sThetaMax.reset()
@@ -475,6 +628,148 @@ class responsiveObj:
         else:
             return
 
+    def updateRange(self, val):
+        """Update truncation percentiles and scale with sliders.
+
+        While a slider is dragged the new values are only stored, the image
+        is binned again when the mouse button is released (see on_release).
+        """
+        if self.segmType == 'main':
+            cfg.perc_min = self.sPercMin.val
+            cfg.perc_max = self.sPercMax.val
+            cfg.scale = self.sScale.val
+            self.rangePending = True
+            if not any(slider.drag_active for slider in
+                       (self.sPercMin, self.sPercMax, self.sScale)):
+                self.rebin()
+        else:
+            return
+
+    def updateValMin(self, text):
+        """Update minimum truncation value (overwrites percentile)."""
+        cfg.valmin = self.parseVal(text)
+        self.updateRange(None)
+
+    def updateValMax(self, text):
+        """Update maximum truncation value (overwrites percentile)."""
+        cfg.valmax = self.parseVal(text)
+        self.updateRange(None)
+
+    def parseVal(self, text):
+        """Convert text box input to value, empty input means not used."""
+        try:
+            return float(text) if text.strip() else float('nan')
+        except ValueError:
+            print('  Invalid value "{}", it is not used.'.format(text))
+            return float('nan')
+
+    def rebin(self):
+        """Truncate, scale and bin the image again with current parameters.
+
+        The foreground, gradient magnitude and extra features are computed
+        again from the input images, which gives the same histogram as a
+        restart with the same parameters.
+        """
+        self.rangePending = False
+        if self.sketch is None:  # only prepared when range is changed once
+            print("  Preparing for range changes...")
+            if self.origRaw is None:  # not kept with cached data
+                origRaw, _ = load_data(self.nii, cfg.force_original_precision,
+                                       cfg.dtype)
+                self.origRaw = np.ascontiguousarray(origRaw[self.crop])
+                del origRaw
+            if cfg.mask is not None:
+                self.mask = load_mask(cfg.mask, self.fullDims, self.crop)
+            self.sketch = prep_percentile_sketch(
+                self.origRaw if self.mask is None
+                else self.origRaw[self.mask],
+                True, cfg.exact_percentiles)
+            self.dataRange = sketch_range(self.sketch)
+        # find new truncation thresholds
+        self.pMin, self.pMax = sketch_percentile(
+            self.sketch, [cfg.perc_min, cfg.perc_max])
+        if not np.isnan(cfg.valmin):
+            self.pMin = cfg.valmin
+        if not np.isnan(cfg.valmax):
+            self.pMax = cfg.valmax
+        self.scale = cfg.scale
+        orig, _ = truncate_scale_range(
+            self.origRaw, self.pMin, self.pMax, scale_factor=cfg.scale,
+            delta=0.0001, data_min=self.dataRange[0],
+            data_max=self.dataRange[1])
+        gra = set_gradient_magnitude(
+            orig, cfg.gramag, crop=self.crop,
+            voxel_size=self.nii.header.get_zooms()[:orig.ndim])
+        # truncation can move voxels to or from zero
+        self.fgIdx = find_foreground(orig, self.mask, cfg.discard_zeros)
+        self.gra = gra.ravel() if self.fgIdx is None else \
+            gra.ravel()[self.fgIdx]
+        del gra
+        self.extraFeatures = load_extra_features(
+            cfg.extra_features, int(np.prod(self.fullDims)), crop=self.crop)
+        if self.fgIdx is not None:
+            self.extraFeatures = [feature[self.fgIdx]
+                                  for feature in self.extraFeatures]
+        counts, ima2volHistMap, self.pix2voxIdx, self.pix2voxPtr, d_min, \
+            d_max, nr_bins, bin_edges = prep_2D_hist_foreground(
+                orig, self.gra, self.fgIdx,
+                extra_features=self.extraFeatures, axes=cfg.hist_axes,
+                discard_zeros=cfg.discard_zeros)
+
+        # update image browser, keep the current view
+        cycPerm = [(0, 1, 2), (2, 0, 1), (1, 2, 0)][self.cycleCount]
+        self.orig = np.transpose(orig, cycPerm)
+        self.invHistVolume = np.transpose(
+            np.reshape(ima2volHistMap, orig.shape), cycPerm)
+        self.slcIdxKey = None
+        self.imaSlcH.set_clim(np.nanmin(orig), np.nanmax(orig))
+
+        # update histogram
+        self.counts, self.nrBins = counts, nr_bins
+        self.volHistMoments = prep_2D_hist_moments(counts, bin_edges)
+        self.volHistH.remove()
+        self.volHistH = plot_2D_hist(self.axes, counts, bin_edges)
+        self.volHistH.set_zorder(0)
+        self.volHistH.set_norm(LogNorm(vmax=np.power(10, self.sHistC.val)))
+        self.cbar.update_normal(self.volHistH)
+        self.sectorObj.set_shape((nr_bins, nr_bins))
+        self.volHistMaskH.set_extent((0, nr_bins, 0, nr_bins))
+        self.idxLasso = np.zeros(nr_bins*nr_bins, dtype=bool)
+        if self.labelNames:
+            print("  Added labels are removed since the bins have changed.")
+            self.clearLabels()
+        pix = np.arange(nr_bins)
+        xv, yv = np.meshgrid(pix, pix)
+        self.lassoPix = np.vstack((xv.flatten(), yv.flatten())).T
+        self.axes.set_xlim(d_min, d_max)
+        self.axes.set_ylim(d_min, d_max)
+        self.updateAxisLabels()
+
+        self.updateSliceNr()
+        self.remapMsks()
+        self.updatePanels(update_slice=True, update_rotation=True,
+                          update_extent=False)
+
+    def updateAxisLabels(self, event=None):
+        """Swap histogram bin indices with original values."""
+        xlabels = [item.get_text() for item in self.axes.get_xticklabels()]
+        orig_range_labels = np.linspace(self.pMin, self.pMax, len(xlabels))
+
+        # Adjust displayed decimals based on data range
+        data_range = self.pMax - self.pMin
+        if data_range > 200:  # arbitrary value
+            xlabels = [('%i' % i) for i in orig_range_labels]
+        elif data_range > 20:
+            xlabels = [('%.1f' % i) for i in orig_range_labels]
+        elif data_range > 2:
+            xlabels = [('%.2f' % i) for i in orig_range_labels]
+        else:
+            xlabels = [('%.3f' % i) for i in orig_range_labels]
+
+        self.axes.set_xticklabels(xlabels)
+        # limits of y axis assumed to be the same as x
+        self.axes.set_yticklabels(xlabels)
+
     def exportNyp(self, event):
         """Export histogram counts as a numpy array."""
         print("  Exporting numpy file...")
@@ -592,6 +887,12 @@ class sector_mask:
         self.cy = y
         self.set_polCrd()  # update polar coordinates
 
+    def set_shape(self, shape):
+        """Set shape of the mask (eg. after changing nr of bins)."""
+        self.shape = shape
+        self.x, self.y = np.ogrid[:shape[0], :shape[1]]
+        self.set_polCrd()  # update polar coordinates
+
     def set_r(self, radius):
         """Set radius of the circle."""
         self.radius = radius
@@ -5,27 +5,82 @@ from __future__ import print_function
 import os
 import numpy as np
 import segmentator.config as cfg
-from segmentator.utils import truncate_range, scale_range, check_data
-from segmentator.utils import set_gradient_magnitude, prep_2D_hist
-from nibabel import load
+from segmentator.utils import preprocess_range
+from segmentator.utils import set_gradient_magnitude, prep_2D_hist_projection
+from segmentator.utils import load_extra_features, prep_ND_hist
+from segmentator.utils import project_ND_hist, prep_2D_hist_slabs
+from segmentator.utils import find_crop, load_mask, find_foreground
+from segmentator.utils import get_crop_margin
+from segmentator.io_utils import load_nifti, load_data
 
 # load data
-nii = load(cfg.filename)
+nii = load_nifti(cfg.filename, indexed=cfg.slab_depth > 0)
 basename = nii.get_filename().split(os.extsep, 1)[0]
 
-# data processing
-orig, _ = check_data(nii.get_fdata(), cfg.force_original_precision)
-orig, _, _ = truncate_range(orig, percMin=cfg.perc_min, percMax=cfg.perc_max)
-orig = scale_range(orig, scale_factor=cfg.scale, delta=0.0001)
-gra = set_gradient_magnitude(orig, cfg.gramag)
+# out of core processing is limited to what can be computed slab by slab
+streaming = cfg.slab_depth > 0
+if streaming and (cfg.gramag not in ['scharr', 'sobel', 'prewitt', 'numpy']
+                  or cfg.extra_features or cfg.exact_percentiles
+                  or cfg.mask is not None
+                  or cfg.force_original_precision
+                  or tuple(cfg.hist_axes) != (0, 1) or len(nii.shape) < 3
+                  or 1 in nii.shape[:3] or np.prod(nii.shape[3:]) > 1):
+    print('Slab processing is not possible with the selected options, '
+          'the whole image is loaded.')
+    streaming = False
 
-# reshape ima (a bit more intuitive for voxel-wise operations)
-ima = np.ndarray.flatten(orig)
-gra = np.ndarray.flatten(gra)
+if streaming:
+    print('Processing in slabs of {} slices...'.format(cfg.slab_depth))
+    counts, _, _, _, _ = prep_2D_hist_slabs(
+        nii, cfg.gramag, slab_depth=cfg.slab_depth, percMin=cfg.perc_min,
+        percMax=cfg.perc_max, scale_factor=cfg.scale, delta=0.0001,
+        discard_zeros=cfg.discard_zeros)
+    extra_features = []
+else:
+    # data processing
+    orig, dims = load_data(nii, cfg.force_original_precision, cfg.dtype)
+    mask = None if cfg.mask is None else load_mask(cfg.mask, dims)
+    voxel_size = nii.header.get_zooms()[:len(dims)]
+    crop = None
+    margin = get_crop_margin(cfg.gramag, voxel_size)
+    if ((cfg.discard_zeros or mask is not None) and not cfg.no_crop
+            and margin is not None):
+        crop = find_crop(orig if mask is None else mask, margin=margin)
+        orig = np.ascontiguousarray(orig[crop])
+        mask = None if mask is None else mask[crop]
+    orig, _, _ = preprocess_range(
+        orig, percMin=cfg.perc_min, percMax=cfg.perc_max,
+        scale_factor=cfg.scale, delta=0.0001, exact=cfg.exact_percentiles,
+        mask=mask)
+    gra = set_gradient_magnitude(orig, cfg.gramag, crop=crop,
+                                 voxel_size=voxel_size)
+
+    # keep only the foreground voxels (a bit more intuitive for voxel-wise
+    # operations)
+    fg_idx = find_foreground(orig, mask, cfg.discard_zeros)
+    ima, gra = orig.ravel(), gra.ravel()
+    extra_features = load_extra_features(
+        cfg.extra_features, int(np.prod(dims)), crop=crop)
+    if fg_idx is not None:
+        ima, gra = ima[fg_idx], gra[fg_idx]
+        extra_features = [feature[fg_idx] for feature in extra_features]
+    if extra_features:
+        bins, nd_counts, vox2binMap, _, _, nr_bins, bin_edges = prep_ND_hist(
+            [ima, gra] + extra_features, discard_zeros=cfg.discard_zeros)
+        counts, _ = project_ND_hist(bins, nd_counts, vox2binMap, nr_bins,
+                                    axes=cfg.hist_axes)
+    else:
+        counts, _, _, _, _, _ = prep_2D_hist_projection(
+            ima, gra, axes=cfg.hist_axes, discard_zeros=cfg.discard_zeros)
 
-counts, _, _, _, _, _ = prep_2D_hist(ima, gra, discard_zeros=cfg.discard_zeros)
 outName = '{}_volHist_pcMax{}_pcMin{}_sc{}'.format(
     basename, cfg.perc_max, cfg.perc_min, int(cfg.scale))
 outName = outName.replace('.', 'pt')
 np.save(outName, counts)
 print('  Image saved as:\n {}'.format(outName))
+
+# save the sparse joint histogram of all images
+if extra_features:
+    outName = outName.replace('_volHist_', '_volHistND_')
+    np.savez(outName, bins=bins, counts=nd_counts, bin_edges=bin_edges)
+    print('  Sparse joint histogram saved as:\n {}'.format(outName))
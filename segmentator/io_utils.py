@@ -0,0 +1,682 @@
+#!/usr/bin/env python
+"""Input and output related functions."""
+
+from __future__ import division, print_function
+import io
+import os
+import gzip
+import shutil
+import hashlib
+import tempfile
+from collections import deque
+from multiprocessing import cpu_count
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from nibabel import load, save, is_proxy, Nifti1Image, Nifti2Image
+
+CACHE_VERSION = 5  # increase when the cached arrays change
+
+
+def load_nifti(filename, indexed=False):
+    """Load a nifti image header without reading the image data.
+
+    Parameters
+    ----------
+    filename : string
+        Path to a nifti file, or to a directory with a DICOM series (see
+        load_dicom_series).
+    indexed : bool
+        Read compressed files through a seek point index, see
+        open_indexed_gzip. Only useful when slabs are read more than once
+        (see iter_slabs), whole image reads decompress the file once anyway.
+
+    Returns
+    -------
+    nii : nibabel image
+        Image with an array proxy. Uncompressed files are memory mapped,
+        compressed files are kept open so that consecutive slab reads do not
+        decompress the file from the start again.
+
+    """
+    if os.path.isdir(filename):
+        return load_dicom_series(filename)
+    fileobj = None
+    if indexed and filename.endswith('.nii.gz'):
+        fileobj = open_indexed_gzip(filename)
+    if fileobj is None:
+        return load(filename, mmap=True, keep_file_open=True)
+    sizeof_hdr = np.frombuffer(fileobj.read(4), dtype='<i4')[0]
+    fileobj.seek(0)
+    klass = Nifti2Image if sizeof_hdr in (540, 469893120) else Nifti1Image
+    nii = klass.from_file_map(klass.make_file_map({'image': fileobj}))
+    nii.set_filename(filename)  # proxy keeps reading from the index
+    return nii
+
+
+def open_indexed_gzip(filename, spacing=2**22):
+    """Open a gzip file for random access with a seek point index.
+
+    Seek points are added while the file is read, so opening does not
+    decompress anything. Later reads of a slab only decompress from the
+    nearest seek point instead of from the start of the file. An index saved
+    by save_gzip_index (filename + '.gzidx') is reused.
+
+    Parameters
+    ----------
+    filename : string
+        Path to a gzip compressed file.
+    spacing : int
+        Number of uncompressed bytes between seek points.
+
+    Returns
+    -------
+    fileobj : indexed_gzip.IndexedGzipFile or None
+        None if the optional indexed_gzip package is not installed.
+
+    """
+    try:
+        from indexed_gzip import IndexedGzipFile
+    except ImportError:
+        return None
+    fileobj = IndexedGzipFile(filename, spacing=spacing)
+    if _is_fresh_index(filename):
+        fileobj.import_index(filename + '.gzidx')
+    return fileobj
+
+
+def _is_fresh_index(filename):
+    """Check if a saved gzip index is newer than the file."""
+    index_file = filename + '.gzidx'
+    return (os.path.isfile(index_file) and
+            os.path.getmtime(index_file) >= os.path.getmtime(filename))
+
+
+def save_gzip_index(nii):
+    """Save the seek point index of an image next to it.
+
+    Only done once the whole file has been read (eg. at the end of
+    iter_slabs), when the index covers the file.
+
+    Parameters
+    ----------
+    nii : nibabel image
+        Input image, see load_nifti. Nothing is done if it is not read
+        through an index.
+
+    """
+    fileobj = getattr(nii.dataobj, 'file_like', None)
+    filename = nii.get_filename()
+    if not hasattr(fileobj, 'export_index') or _is_fresh_index(filename):
+        return
+    try:
+        fileobj.export_index(filename + '.gzidx')
+    except (OSError, IOError):  # eg. read only directory
+        print('  Gzip index could not be saved next to the image.')
+
+
+def get_load_dtype(nii, force_original_precision=False, dtype='float32'):
+    """Find the data type which is used to load the image data.
+
+    Parameters
+    ----------
+    nii : nibabel image
+        Input image.
+    force_original_precision : bool
+        Keep the data type of the stored data instead of dtype.
+    dtype : string
+        Working precision, see config.dtype.
+
+    Returns
+    -------
+    dtype : np.dtype
+        Working precision, or the stored data type. Scaled data is float64
+        (same as nibabel's get_fdata) when original precision is forced.
+
+    """
+    if not force_original_precision:
+        return np.dtype(dtype)
+    dataobj = nii.dataobj
+    if not is_proxy(dataobj):
+        return np.asarray(dataobj).dtype
+    if dataobj.slope == 1 and dataobj.inter == 0:
+        return dataobj.dtype
+    return np.dtype('float64')
+
+
+def load_data(nii, force_original_precision=False, dtype='float32',
+              slab_size=2**24):
+    """Load image data slab by slab into the target data type.
+
+    Unlike nii.get_fdata(), no float64 copy of the whole image is made.
+
+    Parameters
+    ----------
+    nii : nibabel image
+        Input image, see load_nifti.
+    force_original_precision : bool
+        Keep the data type of the stored data instead of dtype.
+    dtype : string
+        Working precision, see config.dtype.
+    slab_size : int
+        Approximate number of voxels that are read at once.
+
+    Returns
+    -------
+    data : np.ndarray
+        Image data (singular dimensions are squeezed).
+    dims : tuple
+        Shape of the image data.
+
+    """
+    print('Input image data type is {}.'.format(nii.get_data_dtype().name))
+    dtype = get_load_dtype(nii, force_original_precision, dtype)
+    if dtype != nii.get_data_dtype():
+        print('  Data type is casted to {}.'.format(dtype.name))
+    dataobj = nii.dataobj
+    if not is_proxy(dataobj) or len(nii.shape) < 2:
+        data = np.asarray(dataobj).astype(dtype)
+    else:
+        data = np.empty(nii.shape, dtype=dtype)
+        # slabs along the last axis are contiguous in nifti files
+        slab_depth = max(1, slab_size // int(np.prod(nii.shape[:-1])))
+        for i in range(0, nii.shape[-1], slab_depth):
+            data[..., i:i + slab_depth] = dataobj[..., i:i + slab_depth]
+    data = np.squeeze(data)  # to prevent singular dimension error
+    return data, data.shape
+
+
+def read_slab(nii, start, stop, dtype='float32'):
+    """Read slices along the third axis of a 3D image.
+
+    Parameters
+    ----------
+    nii : nibabel image
+        Input image, see load_nifti.
+    start, stop : int
+        First and one past the last slice.
+    dtype : string
+        Working precision, see config.dtype.
+
+    Returns
+    -------
+    slab : np.ndarray, shape(x, y, stop - start)
+        Image data of the slab.
+
+    """
+    slab = np.asarray(nii.dataobj[:, :, start:stop, ...])
+    return slab.reshape(slab.shape[:3]).astype(dtype, copy=False)
+
+
+def iter_slabs(nii, slab_depth, halo=0, dtype='float32'):
+    """Iterate over slabs of slices along the third axis of a 3D image.
+
+    Parameters
+    ----------
+    nii : nibabel image
+        Input image, see load_nifti.
+    slab_depth : int
+        Number of slices in a slab (without the halo).
+    halo : int
+        Number of neighbouring slices that are read on both sides of a slab,
+        fewer at the image borders.
+    dtype : string
+        Working precision, see config.dtype.
+
+    Yields
+    ------
+    slab : np.ndarray
+        Image data of the slab including the halo.
+    core : slice
+        Slices of the slab along the third axis without the halo.
+
+    """
+    nr_slices = nii.shape[2]
+    for start in range(0, nr_slices, slab_depth):
+        stop = min(start + slab_depth, nr_slices)
+        first, last = max(start - halo, 0), min(stop + halo, nr_slices)
+        yield (read_slab(nii, first, last, dtype),
+               slice(start - first, stop - first))
+    save_gzip_index(nii)
+
+
+def file_fingerprint(filename, nr_bytes=2**16):
+    """Identify a file by its path, size, modification time and content.
+
+    Only the first and the last bytes are read, hashing the whole content of
+    large images would take as long as processing them.
+
+    Parameters
+    ----------
+    filename : string
+        Path to a file.
+    nr_bytes : int
+        Number of bytes read from both ends of the file.
+
+    Returns
+    -------
+    fingerprint : string
+        Hexadecimal hash.
+
+    """
+    if os.path.isdir(filename):  # eg. DICOM series, only file attributes
+        fingerprint = hashlib.sha1(os.path.abspath(filename).encode())
+        for name in sorted(os.listdir(filename)):
+            stat = os.stat(os.path.join(filename, name))
+            fingerprint.update('{} {} {}'.format(
+                name, stat.st_size, stat.st_mtime).encode())
+        return fingerprint.hexdigest()
+    stat = os.stat(filename)
+    fingerprint = hashlib.sha1()
+    fingerprint.update(os.path.abspath(filename).encode())
+    fingerprint.update('{} {}'.format(stat.st_size, stat.st_mtime).encode())
+    with open(filename, 'rb') as f:
+        fingerprint.update(f.read(nr_bytes))
+        f.seek(max(stat.st_size - nr_bytes, 0))
+        fingerprint.update(f.read())
+    return fingerprint.hexdigest()
+
+
+def get_cache_key(filename, params):
+    """Create cache key of an input file and its processing parameters.
+
+    Parameters
+    ----------
+    filename : string
+        Path to the input image.
+    params : dict
+        Parameters that change the cached arrays.
+
+    Returns
+    -------
+    key : string
+        Hexadecimal hash.
+
+    """
+    key = hashlib.sha1(file_fingerprint(filename).encode())
+    key.update(repr(sorted(params.items())).encode())
+    key.update(str(CACHE_VERSION).encode())
+    return key.hexdigest()
+
+
+def load_cache(cache_dir, key):
+    """Load cached arrays.
+
+    Parameters
+    ----------
+    cache_dir : string
+        Cache directory.
+    key : string
+        Cache key, see get_cache_key.
+
+    Returns
+    -------
+    arrays : dict or None
+        Memory mapped (read only) arrays, None if the key is not cached.
+
+    """
+    path = os.path.join(cache_dir, key)
+    if not os.path.isdir(path):
+        return None
+    try:
+        arrays = {name[:-4]: np.load(os.path.join(path, name), mmap_mode='r')
+                  for name in os.listdir(path) if name.endswith('.npy')}
+        os.utime(path, None)  # mark as recently used
+    except (OSError, ValueError):
+        print('  Cache entry could not be read, it is ignored.')
+        return None
+    return arrays
+
+
+def save_cache(cache_dir, key, arrays, max_size):
+    """Save arrays to the cache and evict least recently used entries.
+
+    Entries which are larger than the whole cache are not saved.
+
+    Parameters
+    ----------
+    cache_dir : string
+        Cache directory.
+    key : string
+        Cache key, see get_cache_key.
+    arrays : dict
+        Arrays to be cached.
+    max_size : float
+        Maximum size of the cache directory in bytes.
+
+    """
+    nbytes = sum(np.asarray(array).nbytes for array in arrays.values())
+    if nbytes > max_size:
+        print('  Preprocessed data ({:.2f} GB) is larger than the cache size '
+              '({:.2f} GB), it is not cached.'.format(nbytes / 2**30,
+                                                      max_size / 2**30))
+        return
+    path = os.path.join(cache_dir, key)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # write to a temporary directory first so that entries are complete
+        temp_path = tempfile.mkdtemp(prefix='.tmp', dir=cache_dir)
+        for name, array in arrays.items():
+            np.save(os.path.join(temp_path, name + '.npy'), array)
+        if os.path.isdir(path):
+            shutil.rmtree(temp_path)
+        else:
+            os.rename(temp_path, path)
+        evict_cache(cache_dir, max_size)
+    except OSError as err:
+        print('  Cache could not be saved ({}).'.format(err))
+
+
+def evict_cache(cache_dir, max_size):
+    """Remove least recently used cache entries until the size fits.
+
+    Parameters
+    ----------
+    cache_dir : string
+        Cache directory.
+    max_size : float
+        Maximum size of the cache directory in bytes.
+
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.startswith('.') or not os.path.isdir(path):
+            continue
+        size = sum(os.path.getsize(os.path.join(path, f))
+                   for f in os.listdir(path))
+        entries.append((os.path.getmtime(path), size, path))
+    total_size = sum(entry[1] for entry in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        shutil.rmtree(path)
+        total_size -= size
+
+
+class ParallelGzipWriter(io.IOBase):
+    """Write-only gzip file which compresses blocks in parallel.
+
+    Every block is a separate gzip member, the concatenated members are a
+    standard gzip file that can be read by any gzip reader (including
+    nibabel). Compression runs in threads because zlib releases the GIL.
+
+    Parameters
+    ----------
+    filename : string
+        Output path.
+    compresslevel : int
+        Gzip compression level between 1 (fastest) and 9 (smallest).
+    nr_threads : int
+        Number of compression threads, 0 uses all available cores.
+    block_size : int
+        Number of uncompressed bytes in a block.
+
+    """
+
+    def __init__(self, filename, compresslevel=1, nr_threads=0,
+                 block_size=2**22):
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.nr_threads = nr_threads if nr_threads > 0 else cpu_count()
+        self.pool = ThreadPoolExecutor(self.nr_threads)
+        self.pending = deque()  # compressed blocks, kept in order
+        self.buffer = bytearray()
+        self.position = 0  # uncompressed bytes written
+        self.fileobj = open(filename, 'wb')
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        """Buffer data and compress full blocks."""
+        data = memoryview(data).cast('B')
+        self.buffer += data
+        self.position += data.nbytes
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return data.nbytes
+
+    def tell(self):
+        """Return the uncompressed position."""
+        return self.position
+
+    def seek(self, offset, whence=0):
+        """Only seeking to the current position is possible."""
+        if whence == 1:
+            offset += self.position
+        if whence == 2 or offset != self.position:
+            raise IOError('ParallelGzipWriter can only write sequentially.')
+        return self.position
+
+    def flush(self):
+        """Compress the buffered data and write all pending blocks."""
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.fileobj.flush()
+
+    def close(self):
+        """Write remaining data and close the file."""
+        if self.closed:
+            return
+        try:
+            super(ParallelGzipWriter, self).close()  # flushes
+        finally:
+            self.pool.shutdown()
+            self.fileobj.close()
+
+    def _submit(self, block):
+        self.pending.append(self.pool.submit(gzip.compress, block,
+                                             self.compresslevel))
+        # limit the memory used by blocks that are waiting to be written
+        while len(self.pending) > 2 * self.nr_threads:
+            self.fileobj.write(self.pending.popleft().result())
+
+
+def get_nifti_ext(compresslevel=1):
+    """Find the nifti file extension of a compression level.
+
+    Parameters
+    ----------
+    compresslevel : int
+        Gzip compression level, 0 means uncompressed.
+
+    Returns
+    -------
+    ext : string
+        '.nii' for uncompressed or '.nii.gz' for compressed files.
+
+    """
+    return '.nii.gz' if compresslevel > 0 else '.nii'
+
+
+def save_nifti(img, filename, compresslevel=1, nr_threads=0):
+    """Save a nifti image, compressing .nii.gz files in parallel.
+
+    Parameters
+    ----------
+    img : nibabel image
+        Image to be saved.
+    filename : string
+        Output path, uncompressed files (.nii) are saved by nibabel.
+    compresslevel : int
+        Gzip compression level between 1 (fastest) and 9 (smallest).
+    nr_threads : int
+        Number of compression threads, 0 uses all available cores.
+
+    """
+    if not filename.endswith('.gz'):
+        save(img, filename)
+        return
+    with ParallelGzipWriter(filename, max(compresslevel, 1),
+                            nr_threads) as f:
+        img.to_file_map(img.make_file_map({'image': f}))
+
+
+class DicomSeriesProxy(object):
+    """Array proxy of a DICOM series, slices are decoded when indexed.
+
+    Image axes are the columns, rows and slices of the series (same as the
+    nifti images converted by common tools). Slices are decoded in parallel
+    threads and rescaled with their own slope and intercept.
+
+    Parameters
+    ----------
+    filenames : list of strings
+        DICOM files of the slices, sorted along the slice normal.
+    shape : tuple
+        Shape of the image (columns, rows, slices).
+    dtype : np.dtype
+        Data type of the stored pixels, float32 if they are rescaled.
+    nr_threads : int
+        Number of decoding threads, 0 uses all available cores.
+
+    """
+
+    is_proxy = True
+    slope, inter = 1., 0.  # rescaling is applied to every slice
+
+    def __init__(self, filenames, shape, dtype, nr_threads=0):
+        self.filenames = filenames
+        self.shape = shape
+        self.ndim = len(shape)
+        self.dtype = np.dtype(dtype)
+        self.nr_threads = nr_threads if nr_threads > 0 else cpu_count()
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        if any(k is Ellipsis for k in key):
+            i = [k is Ellipsis for k in key].index(True)
+            key = (key[:i] + (slice(None),) * (self.ndim - len(key) + 1) +
+                   key[i + 1:])
+        key = key + (slice(None),) * (self.ndim - len(key))
+        slices = np.arange(self.shape[2])[key[2]]
+        data = self.read_slices(np.atleast_1d(slices))
+        return data[key[0], key[1], slice(None) if np.ndim(slices) else 0]
+
+    def read_slices(self, slices):
+        """Decode slices in parallel threads.
+
+        Parameters
+        ----------
+        slices : 1D np.ndarray
+            Slice numbers.
+
+        Returns
+        -------
+        data : np.ndarray, shape(columns, rows, len(slices))
+            Image data of the slices.
+
+        """
+        import pydicom
+        data = np.empty(self.shape[:2] + (len(slices),), dtype=self.dtype)
+
+        def read_slice(i):
+            ds = pydicom.dcmread(self.filenames[slices[i]])
+            slc = ds.pixel_array.T  # rows, columns to columns, rows
+            slope = float(getattr(ds, 'RescaleSlope', 1))
+            inter = float(getattr(ds, 'RescaleIntercept', 0))
+            if slope != 1 or inter != 0:
+                slc = slc * slope + inter
+            data[:, :, i] = slc
+
+        with ThreadPoolExecutor(self.nr_threads) as pool:
+            list(pool.map(read_slice, range(len(slices))))
+        return data
+
+
+def load_dicom_series(directory, nr_threads=0):
+    """Load the headers of a DICOM series as a nifti image.
+
+    The geometry is taken from the image orientation and position patient
+    and the pixel spacing tags. DICOM (LPS) coordinates are converted to
+    nifti (RAS) coordinates. Pixel data are decoded when the image data is
+    indexed, see DicomSeriesProxy.
+
+    Parameters
+    ----------
+    directory : string
+        Directory with the DICOM files. The series with the most slices is
+        used when there are several.
+    nr_threads : int
+        Number of decoding threads, 0 uses all available cores.
+
+    Returns
+    -------
+    nii : nibabel.Nifti1Image
+        Image with a DicomSeriesProxy. Its file name is the directory with a
+        .nii.gz extension, which is used for the exports.
+
+    """
+    try:
+        import pydicom
+    except ImportError:
+        raise ImportError('pydicom is needed to read DICOM series.')
+    series = {}
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path):
+            continue
+        try:
+            ds = pydicom.dcmread(path, stop_before_pixels=True)
+        except pydicom.errors.InvalidDicomError:
+            continue  # not a DICOM file
+        if 'ImagePositionPatient' not in ds:
+            continue  # eg. DICOMDIR
+        series.setdefault(ds.get('SeriesInstanceUID', ''), []).append(
+            (path, ds))
+    if not series:
+        raise ValueError('No DICOM images found in {}.'.format(directory))
+    if len(series) > 1:
+        print('  {} DICOM series found, the one with the most slices is '
+              'used.'.format(len(series)))
+    slices = max(series.values(), key=len)
+
+    # sort slices along the slice normal
+    ds = slices[0][1]
+    orientation = np.array(ds.ImageOrientationPatient, dtype='float64')
+    row_cosine, col_cosine = orientation[:3], orientation[3:]
+    normal = np.cross(row_cosine, col_cosine)
+    positions = np.array([s[1].ImagePositionPatient for s in slices],
+                         dtype='float64')
+    order = np.argsort(positions.dot(normal))
+    positions = positions[order]
+    filenames = [slices[i][0] for i in order]
+
+    # voxel to LPS coordinates, first axis goes along the rows (columns)
+    row_spacing, col_spacing = [float(v) for v in ds.PixelSpacing]
+    affine = np.eye(4)
+    affine[:3, 0] = row_cosine * col_spacing
+    affine[:3, 1] = col_cosine * row_spacing
+    if len(filenames) > 1:
+        affine[:3, 2] = (positions[-1] - positions[0]) / (len(filenames) - 1)
+    else:
+        affine[:3, 2] = normal * float(ds.get('SliceThickness', 1))
+    affine[:3, 3] = positions[0]
+    affine = np.diag([-1, -1, 1, 1]).dot(affine)  # LPS to RAS
+
+    rescaled = any(float(s[1].get('RescaleSlope', 1)) != 1 or
+                   float(s[1].get('RescaleIntercept', 0)) != 0
+                   for s in slices)
+    if rescaled:
+        dtype = np.dtype('float32')
+    else:
+        dtype = np.dtype('uint{}'.format(ds.BitsAllocated))
+        if ds.get('PixelRepresentation', 0) == 1:
+            dtype = np.dtype('int{}'.format(ds.BitsAllocated))
+    shape = (int(ds.Columns), int(ds.Rows), len(filenames))
+    print('DICOM series with {} slices of {}x{} pixels.'.format(
+        shape[2], shape[0], shape[1]))
+    proxy = DicomSeriesProxy(filenames, shape, dtype, nr_threads)
+    nii = Nifti1Image(proxy, affine)
+    nii.header.set_xyzt_units('mm')
+    nii.set_filename(os.path.normpath(directory) + '.nii.gz')
+    return nii
@@ -2,6 +2,7 @@
 """Processing input and plotting."""
 
 from __future__ import division, print_function
+import os
 import numpy as np
 import segmentator.config as cfg
 import matplotlib
@@ -9,38 +10,111 @@ matplotlib.use(cfg.matplotlib_backend)
 print("Matplotlib backend: {}".format(matplotlib.rcParams['backend']))
 import matplotlib.pyplot as plt
 from matplotlib.colors import LogNorm
-from matplotlib.widgets import Slider, Button, LassoSelector
+from matplotlib.widgets import Slider, Button, LassoSelector, TextBox
 from matplotlib import path
-from nibabel import load
-from segmentator.utils import map_ima_to_2D_hist, prep_2D_hist
-from segmentator.utils import truncate_range, scale_range, check_data
+from segmentator.utils import prep_2D_hist_foreground, find_foreground
+from segmentator.utils import load_extra_features, load_mask
+from segmentator.utils import prep_2D_hist_moments
+from segmentator.utils import preprocess_range
 from segmentator.utils import set_gradient_magnitude
 from segmentator.utils import export_gradient_magnitude_image
-from segmentator.gui_utils import sector_mask, responsiveObj
+from segmentator.utils import find_crop, uncrop, get_crop_margin
+from segmentator.io_utils import load_nifti, load_data
+from segmentator.io_utils import file_fingerprint, get_cache_key
+from segmentator.io_utils import load_cache, save_cache
+from segmentator.gui_utils import sector_mask, responsiveObj, plot_2D_hist
 from segmentator.config_gui import palette, axcolor, hovcolor
 
 #
 """Data Processing"""
-nii = load(cfg.filename)
-orig, dims = check_data(nii.get_fdata(), cfg.force_original_precision)
-# Save min and max truncation thresholds to be used in axis labels
-if np.isnan(cfg.valmin) or np.isnan(cfg.valmax):
-    orig, pMin, pMax = truncate_range(orig, percMin=cfg.perc_min,
-                                      percMax=cfg.perc_max)
-else:  # TODO: integrate this into truncate range function
-    orig[orig < cfg.valmin] = cfg.valmin
-    orig[orig > cfg.valmax] = cfg.valmax
-    pMin, pMax = cfg.valmin, cfg.valmax
-
-# Continue with scaling the original truncated image and recomputing gradient
-orig = scale_range(orig, scale_factor=cfg.scale, delta=0.0001)
-gra = set_gradient_magnitude(orig, cfg.gramag)
-if cfg.export_gramag:
-    export_gradient_magnitude_image(gra, nii.get_filename(), cfg.gramag,
-                                    nii.affine)
-# Reshape for voxel-wise operations
-ima = np.copy(orig.flatten())
-gra = gra.flatten()
+nii = load_nifti(cfg.filename)
+cached, cache_key = None, None
+if not cfg.no_cache:
+    cache_params = dict(
+        scale=cfg.scale, perc_min=cfg.perc_min, perc_max=cfg.perc_max,
+        valmin=cfg.valmin, valmax=cfg.valmax, gramag=cfg.gramag,
+        deriche_alpha=cfg.deriche_alpha, gramag_sigma=cfg.gramag_sigma,
+        discard_zeros=cfg.discard_zeros,
+        exact_percentiles=cfg.exact_percentiles, dtype=cfg.dtype,
+        force_original_precision=cfg.force_original_precision,
+        hist_axes=tuple(cfg.hist_axes), no_crop=cfg.no_crop,
+        crop_margin=cfg.crop_margin,
+        extra_features=[file_fingerprint(f) for f in cfg.extra_features])
+    if os.path.isfile(cfg.gramag):
+        cache_params['gramag'] = file_fingerprint(cfg.gramag)
+    if cfg.mask is not None:
+        cache_params['mask'] = file_fingerprint(cfg.mask)
+    cache_key = get_cache_key(cfg.filename, cache_params)
+    cached = load_cache(cfg.cache_dir, cache_key)
+
+if cached is not None and not cfg.export_gramag:
+    print('Loading preprocessed data from cache...')
+    orig, gra = cached['orig'], cached['gra']
+    orig_raw = None  # read again by the GUI when the range is changed
+    dims = orig.shape
+    crop = tuple(slice(start, stop) for start, stop in cached['crop'])
+    full_dims = tuple(cached['full_dims'])
+    extra_features = list(cached['extra_features'])
+    counts, ima2volHistMap = cached['counts'], cached['ima2volHistMap']
+    bin_edges = cached['bin_edges']
+    pix2voxIdx, pix2voxPtr = cached['pix2voxIdx'], cached['pix2voxPtr']
+    pMin, pMax, d_min, d_max, nr_bins = cached['scalars'].tolist()
+    nr_bins = int(nr_bins)
+    # foreground is cheaper to find again than to store
+    mask = None if cfg.mask is None else load_mask(cfg.mask, full_dims, crop)
+    fg_idx = find_foreground(orig, mask, cfg.discard_zeros)
+    mask = None
+else:
+    orig, dims = load_data(nii, cfg.force_original_precision, cfg.dtype)
+    mask = None if cfg.mask is None else load_mask(cfg.mask, dims)
+    voxel_size = nii.header.get_zooms()[:len(dims)]
+    # Crop to the foreground voxels, which are the only ones in the histogram
+    full_dims, crop = dims, tuple(slice(0, n) for n in dims)
+    margin = get_crop_margin(cfg.gramag, voxel_size)
+    if ((cfg.discard_zeros or mask is not None) and not cfg.no_crop
+            and margin is not None):
+        crop = find_crop(orig if mask is None else mask, margin=margin)
+        orig = np.ascontiguousarray(orig[crop])
+        mask = None if mask is None else np.ascontiguousarray(mask[crop])
+        dims = orig.shape
+        print('  Cropped to foreground: {} -> {}'.format(full_dims, dims))
+    # Truncate and scale, save min and max truncation thresholds to be used in
+    # axis labels. The input image is kept for changing the range in the GUI.
+    orig_raw = orig
+    orig, pMin, pMax = preprocess_range(
+        np.copy(orig), percMin=cfg.perc_min, percMax=cfg.perc_max,
+        scale_factor=cfg.scale, delta=0.0001, valmin=cfg.valmin,
+        valmax=cfg.valmax, exact=cfg.exact_percentiles, mask=mask)
+    # Continue with recomputing gradient
+    gra = set_gradient_magnitude(orig, cfg.gramag, crop=crop,
+                                 voxel_size=voxel_size)
+    if cfg.export_gramag:
+        export_gradient_magnitude_image(uncrop(gra, crop, full_dims),
+                                        nii.get_filename(), cfg.gramag,
+                                        nii.affine)
+    # Keep only the foreground voxels of the other images
+    fg_idx = find_foreground(orig, mask, cfg.discard_zeros)
+    mask = None
+    gra = gra.ravel() if fg_idx is None else gra.ravel()[fg_idx]
+    extra_features = load_extra_features(
+        cfg.extra_features, int(np.prod(full_dims)), crop=crop)
+    if fg_idx is not None:
+        extra_features = [feature[fg_idx] for feature in extra_features]
+    counts, ima2volHistMap, pix2voxIdx, pix2voxPtr, d_min, d_max, nr_bins, \
+        bin_edges = prep_2D_hist_foreground(
+            orig, gra, fg_idx, extra_features=extra_features,
+            axes=cfg.hist_axes, discard_zeros=cfg.discard_zeros)
+    if cache_key is not None:
+        cache_arrays = dict(
+            orig=orig, gra=gra, counts=counts,
+            ima2volHistMap=ima2volHistMap,
+            bin_edges=bin_edges, pix2voxIdx=pix2voxIdx, pix2voxPtr=pix2voxPtr,
+            extra_features=np.reshape(extra_features, (-1, gra.size)),
+            crop=[[c.start, c.stop] for c in crop], full_dims=full_dims,
+            scalars=np.array([pMin, pMax, d_min, d_max, nr_bins],
+                             dtype='float64'))
+        save_cache(cfg.cache_dir, cache_key, cache_arrays,
+                   max_size=cfg.cache_size * 2**30)
 
 #
 """Plots"""
@@ -49,25 +123,26 @@ print("Preparing GUI...")
 fig = plt.figure(facecolor='0.775')
 ax = fig.add_subplot(121)
 
-counts, volHistH, d_min, d_max, nr_bins, bin_edges \
-    = prep_2D_hist(ima, gra, discard_zeros=cfg.discard_zeros)
+volHistH = plot_2D_hist(ax, counts, bin_edges)
 
 # Set x-y axis range to the same (x-axis range)
 ax.set_xlim(d_min, d_max)
 ax.set_ylim(d_min, d_max)
-ax.set_xlabel("Intensity f(x)")
-ax.set_ylabel("Gradient Magnitude f'(x)")
+axis_names = ["Intensity f(x)", "Gradient Magnitude f'(x)"] + [
+    os.path.basename(f) for f in cfg.extra_features]
+ax.set_xlabel(axis_names[cfg.hist_axes[0]])
+ax.set_ylabel(axis_names[cfg.hist_axes[1]])
 ax.set_title("2D Histogram")
 
 # Plot colorbar for 2D hist
 volHistH.set_norm(LogNorm(vmax=np.power(10, cfg.cbar_init)))
-fig.colorbar(volHistH, fraction=0.046, pad=0.04)  # magical scaling
+cbar = fig.colorbar(volHistH, fraction=0.046, pad=0.04)  # magical scaling
 
 # Plot 3D ima by default
 ax2 = fig.add_subplot(122)
 sliceNr = int(0.5*dims[2])
-imaSlcH = ax2.imshow(orig[:, :, sliceNr], cmap=plt.cm.gray, vmin=ima.min(),
-                     vmax=ima.max(), interpolation='none',
+imaSlcH = ax2.imshow(orig[:, :, sliceNr], cmap=plt.cm.gray, vmin=orig.min(),
+                     vmax=orig.max(), interpolation='none',
                      extent=[0, dims[1], dims[0], 0], zorder=0)
 
 imaSlcMsk = np.ones(dims[0:2])
@@ -98,7 +173,7 @@ idxLasso = np.zeros(nr_bins*nr_bins, dtype=bool)
 lassoSwitchCount = 0
 lassoErase = 1  # 1 for drawing, 0 for erasing
 flexFig = responsiveObj(figure=ax.figure, axes=ax.axes, axes2=ax2.axes,
-                        segmType='main', orig=orig, nii=nii,
+                        segmType='main', orig=orig, origRaw=orig_raw, nii=nii,
                         sectorObj=sectorObj,
                         nrBins=nr_bins,
                         sliceNr=sliceNr,
@@ -106,16 +181,21 @@ flexFig = responsiveObj(figure=ax.figure, axes=ax.axes, axes2=ax2.axes,
                         imaSlcMsk=imaSlcMsk, imaSlcMskH=imaSlcMskH,
                         volHistMask=volHistMask, volHistMaskH=volHistMaskH,
                         contains=volHistMaskH.contains,
-                        counts=counts,
+                        counts=counts, volHistH=volHistH, cbar=cbar,
                         idxLasso=idxLasso,
                         lassoSwitchCount=lassoSwitchCount,
-                        lassoErase=lassoErase)
+                        lassoErase=lassoErase,
+                        pMin=pMin, pMax=pMax, scale=cfg.scale, gra=gra,
+                        extraFeatures=extra_features, fgIdx=fg_idx,
+                        crop=crop, fullDims=full_dims)
 
 # Make the figure responsive to clicks
 flexFig.connect()
-ima2volHistMap = map_ima_to_2D_hist(xinput=ima, yinput=gra, bins_arr=bin_edges)
 flexFig.invHistVolume = np.reshape(ima2volHistMap, dims)
-ima, gra = None, None
+flexFig.pix2voxIdx, flexFig.pix2voxPtr = pix2voxIdx, pix2voxPtr
+flexFig.volHistMoments = prep_2D_hist_moments(counts, bin_edges)
+flexFig.statsH = fig.text(0.02, 0.98, '', va='top', fontsize='small')
+gra = None
 
 #
 """Sliders and Buttons"""
@@ -137,6 +217,30 @@ aThetaMax = plt.axes([0.15, bottom-0.15, 0.25, 0.025], facecolor=axcolor)
 flexFig.sThetaMax = Slider(aThetaMax, 'ThetaMax', 0, 359.9,
                            valinit=cfg.init_theta[1]-0.1, valfmt='%0.1f')
 
+# Range sliders and text boxes
+aPercMin = plt.axes([0.6, bottom-0.05, 0.25, 0.025], facecolor=axcolor)
+flexFig.sPercMin = Slider(aPercMin, 'PercMin', 0, 50, valinit=cfg.perc_min,
+                          valstep=0.5, valfmt='%0.1f')
+aPercMax = plt.axes([0.6, bottom-0.10, 0.25, 0.025], facecolor=axcolor)
+flexFig.sPercMax = Slider(aPercMax, 'PercMax', 50, 100, valinit=cfg.perc_max,
+                          valstep=0.5, valfmt='%0.1f')
+aScale = plt.axes([0.6, bottom-0.20, 0.25, 0.025], facecolor=axcolor)
+flexFig.sScale = Slider(aScale, 'Scale', 50, 1000, valinit=cfg.scale,
+                        valstep=10, valfmt='%i')
+aValMin = plt.axes([0.40, bottom-0.2475, 0.07, 0.0375])
+flexFig.tValMin = TextBox(aValMin, 'ValMin ', color=axcolor,
+                          hovercolor=hovcolor,
+                          initial='' if np.isnan(cfg.valmin) else cfg.valmin)
+aValMax = plt.axes([0.40, bottom-0.285, 0.07, 0.0375])
+flexFig.tValMax = TextBox(aValMax, 'ValMax ', color=axcolor,
+                          hovercolor=hovcolor,
+                          initial='' if np.isnan(cfg.valmax) else cfg.valmax)
+
+# Add label button
+addLabelax = plt.axes([0.4775, bottom-0.285, 0.065, 0.075])
+flexFig.bAddLabel = Button(addLabelax, 'Add\nLabel',
+                           color=axcolor, hovercolor=hovcolor)
+
 # Cycle button
 cycleax = plt.axes([0.55, bottom-0.2475, 0.075, 0.0375])
 flexFig.bCycle = Button(cycleax, 'Cycle',
@@ -172,30 +276,15 @@ flexFig.bRotate.on_clicked(flexFig.changeRotation)
 flexFig.bExport.on_clicked(flexFig.exportNifti)
 flexFig.bExportNyp.on_clicked(flexFig.exportNyp)
 flexFig.bReset.on_clicked(flexFig.resetGlobal)
-
+flexFig.bAddLabel.on_clicked(flexFig.addLabel)
+flexFig.sPercMin.on_changed(flexFig.updateRange)
+flexFig.sPercMax.on_changed(flexFig.updateRange)
+flexFig.sScale.on_changed(flexFig.updateRange)
+flexFig.tValMin.on_submit(flexFig.updateValMin)
+flexFig.tValMax.on_submit(flexFig.updateValMax)
 
 # TODO: Temporary solution for displaying original x-y axis labels
-def update_axis_labels(event):
-    """Swap histogram bin indices with original values."""
-    xlabels = [item.get_text() for item in ax.get_xticklabels()]
-    orig_range_labels = np.linspace(pMin, pMax, len(xlabels))
-
-    # Adjust displayed decimals based on data range
-    data_range = pMax - pMin
-    if data_range > 200:  # arbitrary value
-        xlabels = [('%i' % i) for i in orig_range_labels]
-    elif data_range > 20:
-        xlabels = [('%.1f' % i) for i in orig_range_labels]
-    elif data_range > 2:
-        xlabels = [('%.2f' % i) for i in orig_range_labels]
-    else:
-        xlabels = [('%.3f' % i) for i in orig_range_labels]
-
-    ax.set_xticklabels(xlabels)
-    ax.set_yticklabels(xlabels)  # limits of y axis assumed to be the same as x
-
-
-fig.canvas.mpl_connect('resize_event', update_axis_labels)
+fig.canvas.mpl_connect('resize_event', flexFig.updateAxisLabels)
 
 #
 """Lasso selection"""
@@ -237,14 +326,14 @@ def lassoSwitch(event):
 # Pixel coordinates
 pix = np.arange(nr_bins)
 xv, yv = np.meshgrid(pix, pix)
-pix = np.vstack((xv.flatten(), yv.flatten())).T
+flexFig.lassoPix = np.vstack((xv.flatten(), yv.flatten())).T
 
 
 def onselect(verts):
     """Lasso related."""
-    global pix
     p = path.Path(verts)
-    newLasIdx = p.contains_points(pix, radius=1.5)  # New lasso indices
+    # New lasso indices
+    newLasIdx = p.contains_points(flexFig.lassoPix, radius=1.5)
     flexFig.idxLasso[newLasIdx] = flexFig.lassoErase  # Update lasso indices
     flexFig.remapMsks()  # Update volume histogram mask
     flexFig.updatePanels(update_slice=False, update_rotation=True,
@@ -12,17 +12,17 @@ matplotlib.use('TkAgg')
 import matplotlib.pyplot as plt
 from matplotlib.colors import LogNorm, ListedColormap, BoundaryNorm
 from matplotlib.widgets import Slider, Button, RadioButtons
-from nibabel import load
-from segmentator.utils import map_ima_to_2D_hist, prep_2D_hist
-from segmentator.utils import truncate_range, scale_range, check_data
+from segmentator.utils import prep_2D_hist, create_2D_hist_index
+from segmentator.utils import preprocess_range
 from segmentator.utils import set_gradient_magnitude
 from segmentator.utils import export_gradient_magnitude_image
-from segmentator.gui_utils import responsiveObj
+from segmentator.io_utils import load_nifti, load_data
+from segmentator.gui_utils import responsiveObj, plot_2D_hist
 from segmentator.config_gui import palette, axcolor, hovcolor
 
 #
 """Load Data"""
-nii = load(cfg.filename)
+nii = load_nifti(cfg.filename)
 ncut_labels = np.load(cfg.ncut)
 
 # transpose the labels
@@ -52,13 +52,15 @@ ima_ncut_labels = ncut_labels.copy()
 
 #
 """Data Processing"""
-orig, dims = check_data(nii.get_fdata(), cfg.force_original_precision)
-# Save min and max truncation thresholds to be used in axis labels
-orig, pMin, pMax = truncate_range(orig, percMin=cfg.perc_min,
-                                  percMax=cfg.perc_max)
-# Continue with scaling the original truncated image and recomputing gradient
-orig = scale_range(orig, scale_factor=cfg.scale, delta=0.0001)
-gra = set_gradient_magnitude(orig, cfg.gramag)
+orig, dims = load_data(nii, cfg.force_original_precision, cfg.dtype)
+# Truncate and scale, save min and max truncation thresholds to be used in
+# axis labels
+orig, pMin, pMax = preprocess_range(
+    orig, percMin=cfg.perc_min, percMax=cfg.perc_max, scale_factor=cfg.scale,
+    delta=0.0001, exact=cfg.exact_percentiles)
+# Continue with recomputing gradient
+gra = set_gradient_magnitude(orig, cfg.gramag,
+                             voxel_size=nii.header.get_zooms()[:len(dims)])
 if cfg.export_gramag:
     export_gradient_magnitude_image(gra, nii.get_filename(), nii.affine)
 
@@ -73,8 +75,9 @@ print("Preparing GUI...")
 fig = plt.figure(facecolor='0.775')
 ax = fig.add_subplot(121)
 
-counts, volHistH, d_min, d_max, nr_bins, bin_edges \
+counts, ima2volHistMap, d_min, d_max, nr_bins, bin_edges \
     = prep_2D_hist(ima, gra, discard_zeros=cfg.discard_zeros)
+volHistH = plot_2D_hist(ax, counts, bin_edges)
 
 ax.set_xlim(d_min, d_max)
 ax.set_ylim(d_min, d_max)
@@ -144,13 +147,14 @@ flexFig = responsiveObj(figure=ax.figure, axes=ax.axes, axes2=ax2.axes,
                         counterField=np.zeros((nr_bins, nr_bins)),
                         orig_ncut_labels=orig_ncut_labels,
                         ima_ncut_labels=ima_ncut_labels,
-                        lMax=lMax)
+                        lMax=lMax, pMin=pMin, pMax=pMax, volHistH=volHistH)
 
 # Make the figure responsive to clicks
 flexFig.connect()
 # Get mapping from image slice to volume histogram
-ima2volHistMap = map_ima_to_2D_hist(xinput=ima, yinput=gra, bins_arr=bin_edges)
 flexFig.invHistVolume = np.reshape(ima2volHistMap, dims)
+flexFig.pix2voxIdx, flexFig.pix2voxPtr = create_2D_hist_index(
+    ima2volHistMap, nr_bins)
 
 # %%
 """Sliders and Buttons"""
@@ -217,26 +221,6 @@ flexFig.radio.on_clicked(flexFig.updateLabelsRadio)
 
 
 # TODO: Temporary solution for displaying original x-y axis labels
-def update_axis_labels(event):
-    """Swap histogram bin indices with original values."""
-    xlabels = [item.get_text() for item in ax.get_xticklabels()]
-    orig_range_labels = np.linspace(pMin, pMax, len(xlabels))
-
-    # Adjust displayed decimals based on data range
-    data_range = pMax - pMin
-    if data_range > 200:  # arbitrary value
-        xlabels = [('%i' % i) for i in orig_range_labels]
-    elif data_range > 20:
-        xlabels = [('%.1f' % i) for i in orig_range_labels]
-    elif data_range > 2:
-        xlabels = [('%.2f' % i) for i in orig_range_labels]
-    else:
-        xlabels = [('%.3f' % i) for i in orig_range_labels]
-
-    ax.set_xticklabels(xlabels)
-    ax.set_yticklabels(xlabels)  # limits of y axis assumed to be the same as x
-
-
-fig.canvas.mpl_connect('resize_event', update_axis_labels)
+fig.canvas.mpl_connect('resize_event', flexFig.updateAxisLabels)
 
 plt.show()
@@ -0,0 +1,155 @@
+"""Test input and output functions."""
+
+import numpy as np
+from nibabel import Nifti1Image, save
+import os
+import gzip
+import pytest
+from segmentator.io_utils import load_nifti, load_data
+from segmentator.io_utils import get_cache_key, load_cache, save_cache
+from segmentator.io_utils import ParallelGzipWriter, save_nifti, read_slab
+from segmentator.io_utils import iter_slabs
+from segmentator.io_utils import load_dicom_series
+import segmentator.config as cfg
+
+
+def test_load_data(tmp_path):
+    """Test slab loading of stored and scaled nifti data."""
+    # Given
+    data = np.random.randint(-100, 100, (7, 6, 5)).astype('int16')
+    nii = Nifti1Image(data, np.eye(4))
+    nii.header.set_slope_inter(0.5, 3)
+    for ext in ['.nii', '.nii.gz']:
+        filename = str(tmp_path / ('test' + ext))
+        save(nii, filename)
+        expected = load_nifti(filename).get_fdata()
+        # When
+        output, dims = load_data(load_nifti(filename), slab_size=50)
+        native, _ = load_data(load_nifti(filename),
+                              force_original_precision=True)
+        # Then
+        assert output.dtype == np.float32 and dims == data.shape
+        assert np.array_equal(output, expected.astype('float32'))
+        assert np.array_equal(native, expected)
+
+
+def test_cache(tmp_path):
+    """Test saving, loading and eviction of cache entries."""
+    # Given
+    filename = str(tmp_path / 'test.nii')
+    save(Nifti1Image(np.zeros((4, 5, 6), dtype='float32'), np.eye(4)),
+         filename)
+    cache_dir = str(tmp_path / 'cache')
+    arrays = dict(orig=np.random.random((4, 5, 6)), bins=np.arange(10))
+    keys = [get_cache_key(filename, dict(scale=s)) for s in [400, 500, 600]]
+    # When
+    save_cache(cache_dir, keys[0], arrays, max_size=10**6)
+    output = load_cache(cache_dir, keys[0])
+    os.utime(os.path.join(cache_dir, keys[0]), (0, 0))  # least recent
+    for key in keys[1:]:
+        save_cache(cache_dir, key, arrays, max_size=2.5 * 1500)
+    too_large_key = get_cache_key(filename, dict(scale=700))
+    save_cache(cache_dir, too_large_key, arrays, max_size=1000)
+    # Then
+    assert len(set(keys)) == 3
+    assert all(np.array_equal(output[k], arrays[k]) for k in arrays)
+    assert load_cache(cache_dir, keys[0]) is None
+    assert load_cache(cache_dir, keys[2]) is not None
+    assert not os.path.exists(os.path.join(cache_dir, too_large_key))
+
+
+def test_cache_size_budget():
+    """Test that the default cache size fits a large preprocessed image."""
+    # Given
+    nr_voxels = 700 * 700 * 500
+    nr_bins = int(cfg.scale)
+    itemsizes = [
+        np.dtype(cfg.dtype).itemsize,  # orig
+        np.dtype(cfg.dtype).itemsize,  # gra (all voxels in foreground)
+        np.min_scalar_type(nr_bins**2).itemsize,  # ima2volHistMap
+        np.min_scalar_type(nr_voxels).itemsize]  # pix2voxIdx
+    # When
+    nbytes = nr_voxels * sum(itemsizes) + 8 * (2 * nr_bins**2 + 1)
+    # Then
+    assert nbytes < cfg.cache_size * 2**30
+
+
+def test_parallel_gzip(tmp_path):
+    """Test multi-member gzip output and parallel nifti export."""
+    # Given
+    raw = np.random.randint(0, 10, 10**5).astype('uint8').tobytes()
+    data = np.random.random((7, 6, 5)).astype('float32')
+    filename = str(tmp_path / 'test.gz')
+    # When
+    with ParallelGzipWriter(filename, nr_threads=2, block_size=999) as f:
+        f.write(raw[:500])
+        f.write(raw[500:])
+        position = f.tell()
+    for ext in ['.nii', '.nii.gz']:
+        save_nifti(Nifti1Image(data, np.eye(4)), str(tmp_path / ('t' + ext)),
+                   compresslevel=6, nr_threads=2)
+    # Then
+    assert position == len(raw)
+    with gzip.open(filename, 'rb') as f:
+        assert f.read() == raw
+    for ext in ['.nii', '.nii.gz']:
+        output = load_nifti(str(tmp_path / ('t' + ext))).get_fdata()
+        assert np.array_equal(output, data)
+
+
+def test_load_nifti_indexed(tmp_path):
+    """Test slab reads through the saved gzip index."""
+    pytest.importorskip('indexed_gzip')
+    # Given
+    data = np.random.random((7, 6, 5)).astype('float32')
+    filename = str(tmp_path / 'test.nii.gz')
+    save(Nifti1Image(data, np.eye(4)), filename)
+    # When
+    nii = load_nifti(filename, indexed=True)
+    index_at_open = os.path.isfile(filename + '.gzidx')
+    slabs = [slab for slab, _ in iter_slabs(nii, 2)]  # saves the index
+    nii = load_nifti(filename, indexed=True)
+    # Then
+    assert not index_at_open
+    assert np.array_equal(np.concatenate(slabs, axis=2), data)
+    assert os.path.isfile(filename + '.gzidx')
+    assert nii.get_filename() == filename
+    assert np.array_equal(read_slab(nii, 2, 4), data[:, :, 2:4])
+
+
+def test_load_dicom_series(tmp_path):
+    """Test DICOM series geometry and lazy slice decoding."""
+    pydicom = pytest.importorskip('pydicom')
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+    # Given
+    pixels = np.random.randint(0, 1000, (5, 4, 3)).astype('uint16')
+    series_uid = generate_uid()
+    for k in [3, 0, 4, 1, 2]:  # file names are not in slice order
+        ds = Dataset()
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+        ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds.preamble = b'\0' * 128
+        ds.SeriesInstanceUID = series_uid
+        ds.Rows, ds.Columns = pixels.shape[1:]
+        ds.SamplesPerPixel, ds.PhotometricInterpretation = 1, 'MONOCHROME2'
+        ds.BitsAllocated, ds.BitsStored, ds.HighBit = 16, 16, 15
+        ds.PixelRepresentation = 0
+        ds.PixelSpacing = [0.5, 0.8]
+        ds.ImageOrientationPatient = [0, 1, 0, 0, 0, -1]  # sagittal
+        ds.ImagePositionPatient = [10 - 1.5 * k, -20, 30]
+        ds.RescaleSlope, ds.RescaleIntercept = 2, -10
+        ds.PixelData = pixels[k].tobytes()
+        pydicom.dcmwrite(str(tmp_path / 'slice{}.dcm'.format(4 - k)), ds)
+    expected_affine = np.array([[0, 0, 1.5, -10], [-0.8, 0, 0, 20],
+                                [0, -0.5, 0, 30], [0, 0, 0, 1]])
+    expected = np.transpose(pixels, (2, 1, 0)) * 2. - 10
+    # When
+    nii = load_dicom_series(str(tmp_path), nr_threads=2)
+    output, _ = load_data(nii, slab_size=20)
+    # Then
+    assert np.allclose(nii.affine, expected_affine)
+    assert np.array_equal(output, expected)
+    assert np.array_equal(read_slab(nii, 1, 3), expected[:, :, 1:3])
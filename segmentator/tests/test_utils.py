@@ -1,7 +1,28 @@
 """Test utility functions."""
 
 import numpy as np
-from segmentator.utils import truncate_range, scale_range
+import pytest
+from nibabel import Nifti1Image, save
+from segmentator.utils import truncate_range, scale_range, map_2D_hist_to_ima
+from segmentator.utils import prep_2D_hist, create_2D_hist_index
+from segmentator.utils import compute_bin_indices
+from segmentator.utils import prep_percentile_sketch, sketch_percentile
+from segmentator.utils import truncate_scale_range, preprocess_range
+from segmentator.utils import map_2D_hist_to_ima_indexed
+from segmentator.utils import prep_2D_hist_moments, selection_stats
+from segmentator.utils import prep_ND_hist, project_ND_hist
+from segmentator.utils import compute_gradient_magnitude, prep_2D_hist_slabs
+from segmentator.utils import find_crop, uncrop, get_crop_margin
+from segmentator.utils import set_gradient_magnitude
+import segmentator.config as cfg
+from segmentator.utils import find_foreground, prep_2D_hist_foreground
+from segmentator.utils import relabel, get_label_dtype
+from segmentator.utils import create_3D_kernel
+from segmentator.utils import compute_slab_gradient_magnitude
+from segmentator.utils import compute_gaussian_gradient_magnitude
+from segmentator.deriche_prepare import deriche_3D_lfilter
+from scipy.ndimage import convolve
+from segmentator.io_utils import load_nifti
 
 
 def test_truncate_range():
@@ -32,3 +53,383 @@ def test_scale_range():
     # Then
     assert all([np.nanmin(output) >= expected[0],
                 np.nanmax(output) < expected[1]])
+
+
+def test_map_2D_hist_to_ima():
+    """Test volume histogram to image mapping."""
+    # Given
+    nr_bins = 8
+    vol_hist_mask = np.random.randint(0, 5, (nr_bins, nr_bins))
+    ima2hist = np.random.randint(0, nr_bins*nr_bins, 100)
+    ima2hist[:3] = [-1, nr_bins*nr_bins, nr_bins*nr_bins + 5]  # out of hist
+    expected = np.zeros(ima2hist.shape)
+    for idx in np.unique(vol_hist_mask):
+        lin_indices = np.where(vol_hist_mask.flatten() == idx)[0]
+        expected[np.isin(ima2hist, lin_indices)] = idx
+    # When
+    output = map_2D_hist_to_ima(ima2hist, vol_hist_mask)
+    # Then
+    assert np.array_equal(output, expected)
+
+
+def test_prep_2D_hist():
+    """Test 2D histogram counts."""
+    # Given
+    ima = np.random.random(1000) * 20
+    gra = np.random.random(1000) * 25  # some values are out of histogram
+    ima[:50] = 0
+    bins = np.arange(np.round(np.min(ima[50:])), np.round(np.max(ima))+1)
+    expected, _, _ = np.histogram2d(ima[50:], gra[50:], bins=bins)
+    # When
+    counts, _, _, _, _, _ = prep_2D_hist(ima, gra, discard_zeros=True)
+    # Then
+    assert np.array_equal(counts, expected)
+
+
+def test_map_2D_hist_to_ima_indexed():
+    """Test volume histogram to image mapping with the histogram index."""
+    # Given
+    nr_bins = 8
+    vol_hist_mask = np.random.randint(0, 5, (nr_bins, nr_bins))
+    ima2hist = np.random.randint(0, nr_bins*nr_bins + 1, 100)
+    expected = map_2D_hist_to_ima(ima2hist, vol_hist_mask)
+    # When
+    idx, ptr = create_2D_hist_index(ima2hist, nr_bins, chunk_size=7)
+    output = map_2D_hist_to_ima_indexed(idx, ptr, vol_hist_mask, 100)
+    # Then
+    assert np.array_equal(idx, np.argsort(ima2hist, kind='stable'))
+    assert np.array_equal(output, expected)
+
+
+def test_compute_bin_indices():
+    """Test arithmetic binning."""
+    # Given
+    data = np.random.random(1000).astype('float32') * 30 - 5
+    data[:4] = [0, 20, 7, np.nan]  # bin edges and nan
+    bins = np.arange(0, 21)
+    expected = np.digitize(data, bins) - 1
+    expected[data == bins[-1]] = len(bins) - 2
+    expected[(expected < 0) | (expected >= len(bins) - 1)] = -1
+    # When
+    output = compute_bin_indices(data, bins)
+    # Then
+    assert np.array_equal(output, expected)
+
+
+def test_truncate_scale_range():
+    """Test range truncation and scaling with a percentile sketch."""
+    # Given
+    data = np.random.random(100)
+    data.ravel()[np.random.choice(data.size, 10, replace=False)] = 0
+    p_min, p_max = 2.5, 97.5
+    expected, exp_min, exp_max = truncate_range(
+        np.copy(data), percMin=p_min, percMax=p_max)
+    expected = scale_range(expected, scale_factor=42., delta=0.01)
+    # When
+    sketch = prep_percentile_sketch(data)
+    out_min, out_max = sketch_percentile(sketch, [p_min, p_max])
+    output, _ = truncate_scale_range(data, out_min, out_max,
+                                     scale_factor=42., delta=0.01)
+    # Then
+    assert np.allclose([out_min, out_max], [exp_min, exp_max])
+    assert np.allclose(output, expected)
+
+
+def test_preprocess_range():
+    """Test fused truncation and scaling with estimated percentiles."""
+    # Given
+    data = np.random.random(10**6).astype('float32') * 100
+    data[np.random.choice(data.size, 1000, replace=False)] = 0
+    p_min, p_max = 2.5, 97.5
+    expected, exp_min, exp_max = truncate_range(
+        data.astype('float64'), percMin=p_min, percMax=p_max)
+    expected = scale_range(expected, scale_factor=42., delta=0.01)
+    # When
+    output, out_min, out_max = preprocess_range(
+        data, percMin=p_min, percMax=p_max, scale_factor=42., delta=0.01)
+    # Then
+    assert np.allclose([out_min, out_max], [exp_min, exp_max], atol=0.01)
+    assert np.allclose(output, expected, atol=0.01)
+    assert output.dtype == np.float32
+
+
+def test_preprocess_range_clipped_zeros():
+    """Test that voxels clipped to the minimum are binned like the baseline."""
+    # Given
+    rng = np.random.RandomState(0)
+    data = rng.random_sample(10**5).astype('float32') * 100
+    data[:1000] = 0
+    gra = rng.random_sample(10**5) * 40
+    expected, _, _ = truncate_range(data.astype('float64'), percMin=2.5,
+                                    percMax=97.5)
+    expected = scale_range(expected, scale_factor=50., delta=0.0001)
+    exp_counts = prep_2D_hist(expected, gra)[0]
+    # When
+    output, out_min, _ = preprocess_range(
+        np.copy(data), percMin=2.5, percMax=97.5, scale_factor=50.,
+        delta=0.0001, exact=True)
+    counts = prep_2D_hist(output, gra)[0]
+    # Then
+    assert np.all(output[data <= out_min] == 0)
+    assert counts.sum() == exp_counts.sum()
+    assert np.array_equal(counts[0], exp_counts[0])
+
+
+def test_selection_stats():
+    """Test selected voxel statistics from the histogram counts."""
+    # Given
+    ima = np.random.random(1000) * 20
+    gra = np.random.random(1000) * 15
+    counts, ima2hist, _, _, nr_bins, bin_edges = prep_2D_hist(ima, gra)
+    vol_hist_mask = np.random.randint(0, 2, (nr_bins, nr_bins))
+    selected = map_2D_hist_to_ima(ima2hist, vol_hist_mask) == 1
+    # When
+    moments = prep_2D_hist_moments(counts, bin_edges)
+    nr_vox, mean_ima, mean_gra = selection_stats(
+        moments, vol_hist_mask.ravel() == 1)
+    # Then
+    assert nr_vox == np.sum(selected)
+    assert np.abs(mean_ima - np.mean(ima[selected])) < 0.5
+    assert np.abs(mean_gra - np.mean(gra[selected])) < 0.5
+
+
+def test_project_ND_hist():
+    """Test 2D projections of the sparse joint histogram."""
+    # Given
+    ima = np.random.random(1000) * 20
+    gra = np.random.random(1000) * 25  # some values are out of histogram
+    ext = np.random.random(1000) * 15
+    ima[:50] = 0
+    expected, expected_map, _, _, _, _ = prep_2D_hist(ima, ext)
+    # When
+    bins, counts, vox2bin, _, _, nr_bins, _ = prep_ND_hist([ima, gra, ext])
+    output, output_map = project_ND_hist(bins, counts, vox2bin, nr_bins,
+                                         axes=(0, 2))
+    # Then
+    assert bins.shape == (3, counts.size)
+    assert np.array_equal(output, expected)
+    assert np.array_equal(output_map, expected_map)
+
+
+def test_compute_gradient_magnitude_precision():
+    """Test that gradient magnitude keeps the working precision."""
+    # Given
+    ima = np.random.random((10, 11, 12)).astype('float32')
+    # When
+    outputs = [compute_gradient_magnitude(ima, method=m)
+               for m in ['scharr', 'sobel', 'prewitt', 'numpy']]
+    # Then
+    assert all(out.dtype == np.float32 for out in outputs)
+    assert all(out.shape == ima.shape for out in outputs)
+
+
+def test_prep_2D_hist_slabs(tmp_path):
+    """Test out of core 2D histogram counts."""
+    # Given
+    data = np.random.random((12, 13, 14)).astype('float32') * 100
+    data[:2, ...] = 0
+    filename = str(tmp_path / 'test.nii.gz')
+    save(Nifti1Image(data, np.eye(4)), filename)
+    empty_filename = str(tmp_path / 'empty.nii.gz')
+    save(Nifti1Image(np.zeros_like(data), np.eye(4)), empty_filename)
+    ima, _, _ = preprocess_range(np.copy(data), scale_factor=100, delta=0.01)
+    for method in ['scharr', 'numpy']:
+        gra = compute_gradient_magnitude(ima, method=method)
+        expected, _, _, _, _, _ = prep_2D_hist(ima.ravel(), gra.ravel())
+        # When
+        output, _, _, _, _ = prep_2D_hist_slabs(
+            load_nifti(filename), method, slab_depth=3, scale_factor=100,
+            delta=0.01)
+        # Then
+        assert np.array_equal(output, expected)
+    with pytest.raises(ValueError):
+        prep_2D_hist_slabs(load_nifti(empty_filename), slab_depth=3)
+
+
+def test_find_crop():
+    """Test cropping to the non-zero bounding box and padding back."""
+    # Given
+    data = np.zeros((20, 21, 22))
+    data[5:9, 3:15, 10:22] = np.random.random((4, 12, 12)) + 1
+    expected = (slice(3, 11), slice(1, 17), slice(8, 22))
+    # When
+    crop = find_crop(data, margin=2)
+    output = uncrop(data[crop], crop, data.shape)
+    background = uncrop(data[crop], crop, data.shape, background=data + 1)
+    # Then
+    assert crop == expected
+    assert np.array_equal(output, data)
+    outside = np.ones(data.shape, dtype=bool)
+    outside[crop] = False
+    assert np.array_equal(background[outside], data[outside] + 1)
+    assert np.array_equal(background[crop], data[crop])
+
+
+def test_prep_2D_hist_foreground():
+    """Test 2D histogram and index of the foreground voxels only."""
+    # Given
+    ima = np.random.random((10, 11, 12)) * 20
+    gra = np.random.random((10, 11, 12)) * 25
+    ima[:3, ...] = 0
+    mask = np.ones(ima.shape, dtype=bool)
+    mask[:, :2, :] = False
+    expected, _, _, _, nr_bins, _ = prep_2D_hist(ima[mask], gra[mask])
+    vol_hist_mask = np.random.randint(0, 5, (nr_bins, nr_bins))
+    # When
+    fg_idx = find_foreground(ima, mask)
+    output, vox2pix, idx, ptr, _, _, _, _ = prep_2D_hist_foreground(
+        ima, gra.ravel()[fg_idx], fg_idx)
+    labels = map_2D_hist_to_ima_indexed(idx, ptr, vol_hist_mask, ima.size)
+    # Then
+    background = (ima.ravel() == 0) | ~mask.ravel()
+    assert np.array_equal(output, expected)
+    assert np.all(vox2pix[background] == nr_bins*nr_bins)
+    assert np.all(labels[background] == 0)
+    assert np.array_equal(labels, map_2D_hist_to_ima(vox2pix, vol_hist_mask))
+
+
+def test_relabel():
+    """Test consecutive relabeling and label data types."""
+    # Given
+    labels = np.array([[0, 7.5, 300], [7.5, 1000, 0]])
+    expected = np.array([[0, 1, 2], [1, 3, 0]])
+    # When
+    output = relabel(labels)
+    # Then
+    assert np.array_equal(output, expected)
+    assert get_label_dtype(output.max()) == np.uint8
+    assert get_label_dtype(300) == np.uint16
+
+
+def test_separable_gradient_magnitude():
+    """Test separable kernels against the 3D kernel convolutions."""
+    # Given
+    ima = np.random.random((10, 11, 12)).astype('float32') * 100
+    for method in ['scharr', 'sobel', 'prewitt']:
+        kernel = create_3D_kernel(method)
+        gra = [convolve(ima.astype('float64'), k.astype('float64'))
+               for k in kernel]
+        expected = np.sqrt(np.sum(np.power(gra, 2.), axis=0) * 2.)
+        # When
+        output = compute_gradient_magnitude(ima, method=method)
+        # Then
+        assert output.dtype == np.float32
+        assert np.allclose(output, expected, rtol=1e-5, atol=1e-4)
+
+
+def test_slab_gradient_magnitude():
+    """Test that slab parallel gradients are identical to the serial ones."""
+    # Given
+    ima = np.random.random((10, 11, 40)).astype('float32') * 100
+    for method in ['scharr', 'sobel', 'prewitt', 'numpy']:
+        expected = compute_gradient_magnitude(ima, method=method,
+                                              nr_threads=1)
+        # When
+        output = compute_slab_gradient_magnitude(ima, method, nr_threads=3,
+                                                 slab_depth=1)
+        default = compute_slab_gradient_magnitude(ima, method, nr_threads=3)
+        # Then
+        assert np.array_equal(output, expected)
+        assert np.array_equal(default, expected)
+
+
+def deriche_reference(data, alpha, axes):
+    """Loop implementation of one Deriche derivative (Monga et al. 1991)."""
+    data = np.moveaxis(data.astype('float64'), axes, (0, 1, 2))
+    s = (1 - np.exp(-alpha))**2 / (1 + 2*alpha*np.exp(-alpha)
+                                   - np.exp(-2*alpha))
+    a_0, a_1 = s, s * (alpha - 1) * np.exp(-alpha)
+    b_1, b_2 = -2 * np.exp(-alpha), np.exp(-2 * alpha)
+    a_2, a_3 = a_1 - s * b_1, -s * b_2
+    for axis in range(3):
+        data = np.moveaxis(data, axis, 0)
+        pos, neg = np.zeros(data.shape), np.zeros(data.shape)
+        n = data.shape[0]
+        for i in range(n):
+            if i > 2:
+                if axis == 0:
+                    pos[i] = data[i-1] - b_1*pos[i-1] - b_2*pos[i-2]
+                else:
+                    pos[i] = (a_0*data[i] + a_1*data[i-1] - b_1*pos[i-1]
+                              - b_2*pos[i-2])
+            i = -i % n  # inverse index
+            if i < n - 2:
+                if axis == 0:
+                    neg[i] = data[i+1] - b_1*neg[i+1] - b_2*neg[i+2]
+                else:
+                    neg[i] = (a_2*data[i+1] + a_3*data[i+2] - b_1*neg[i+1]
+                              - b_2*neg[i+2])
+        data = alpha*(pos - neg) if axis == 0 else pos + neg
+        data = np.moveaxis(data, 0, axis)
+    return np.moveaxis(data, (0, 1, 2), axes)
+
+
+def test_deriche_3D():
+    """Test the Deriche extension against the loop implementation."""
+    # Given
+    deriche_3D = pytest.importorskip('segmentator.deriche_3D').deriche_3D
+    ima = np.random.random((7, 8, 9)).astype('float32') * 100
+    expected = [deriche_reference(ima, 2., axes)
+                for axes in [(0, 1, 2), (1, 2, 0), (2, 0, 1)]]
+    # When
+    output = deriche_3D(ima, alpha=2., nr_threads=2)
+    # Then
+    assert output.dtype == np.float32
+    assert np.allclose(output, expected, rtol=1e-5, atol=1e-3)
+
+
+def test_deriche_3D_lfilter():
+    """Test the vectorized Deriche fallback against the loop implementation."""
+    # Given
+    ima = np.random.random((7, 8, 9)).astype('float32') * 100
+    expected = [deriche_reference(ima, 2., axes)
+                for axes in [(0, 1, 2), (1, 2, 0), (2, 0, 1)]]
+    # When
+    output = deriche_3D_lfilter(ima, alpha=2., nr_threads=2)
+    # Then
+    assert output.dtype == np.float32
+    assert np.allclose(output, expected, rtol=1e-5, atol=1e-3)
+
+
+def test_gaussian_gradient_magnitude():
+    """Test Gaussian gradients of a step edge and the FFT path."""
+    # Given
+    ima = np.zeros((20, 21, 22), dtype='float32')
+    ima[:, 10:, :] = 100
+    ima += np.random.random(ima.shape).astype('float32')
+    voxel_size = (1., 0.5, 2.)
+    # When
+    output = compute_gaussian_gradient_magnitude(ima, 2., voxel_size)
+    output_fft = compute_gaussian_gradient_magnitude(ima, 2., voxel_size,
+                                                     fft_sigma=0.)
+    # Then
+    assert output.dtype == output_fft.dtype == np.float32
+    assert np.allclose(output_fft, output, rtol=1e-4, atol=1e-3)
+    assert np.abs(output[:, 9:11, :].max() - 50) < 1
+
+
+def test_crop_gradient_magnitude(tmp_path):
+    """Test that cropping keeps the foreground gradients of every option."""
+    # Given
+    data = np.zeros((40, 40, 40), dtype='float32')
+    data[10:30, 10:30, 10:30] = np.random.random((20, 20, 20)) * 100 + 1
+    ima, _, _ = preprocess_range(np.copy(data), scale_factor=100, delta=0.01)
+    gra_filename = str(tmp_path / 'gra.nii.gz')
+    save(Nifti1Image(compute_gradient_magnitude(ima), np.eye(4)),
+         gra_filename)
+    voxel_size = (1., 1., 1.5)
+    foreground = data != 0
+    for option in cfg.gramag_options + [gra_filename]:
+        expected = set_gradient_magnitude(ima, option, voxel_size=voxel_size)
+        # When
+        margin = get_crop_margin(option, voxel_size)
+        if margin is None:  # not cropped
+            continue
+        crop = find_crop(data, margin=margin)
+        output = set_gradient_magnitude(np.ascontiguousarray(ima[crop]),
+                                        option, crop=crop,
+                                        voxel_size=voxel_size)
+        # Then
+        assert output.shape != expected.shape
+        assert np.array_equal(output[foreground[crop]],
+                              expected[foreground])
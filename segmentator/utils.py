@@ -4,10 +4,14 @@
 from __future__ import division, print_function
 import os
 import numpy as np
-import matplotlib.pyplot as plt
 import segmentator.config as cfg
-from nibabel import load, Nifti1Image, save
-from scipy.ndimage import convolve
+from nibabel import Nifti1Image
+from segmentator.io_utils import load_nifti, load_data, iter_slabs
+from segmentator.io_utils import save_nifti, get_nifti_ext
+from scipy.ndimage import convolve1d, gaussian_filter
+from scipy import fft
+from multiprocessing import cpu_count
+from concurrent.futures import ThreadPoolExecutor
 from time import time
 
 
@@ -29,6 +33,44 @@ def sub2ind(array_shape, rows, cols):
     return (cols*array_shape + rows)
 
 
+def compute_bin_indices(data, bins_arr):
+    """Find bin indices of data (similar to np.digitize(data, bins_arr)-1).
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Input data.
+    bins_arr : np.ndarray
+        Array of bin edges.
+
+    Returns
+    -------
+    idx : np.ndarray
+        Bin indices, same shape as data. Data outside of the bins (or nan)
+        are marked with -1.
+
+    Notes
+    -----
+    Equal width bins (eg. from np.arange) are computed arithmetically with
+    floor instead of a binary search over the bin edges. Right most edge is
+    included in the last bin (same as numpy histograms).
+
+    """
+    bins_arr = np.asarray(bins_arr)
+    nr_bins = len(bins_arr) - 1
+    width = bins_arr[1] - bins_arr[0]
+    if np.all(np.diff(bins_arr) == width):
+        idx = np.floor((data - float(bins_arr[0])) / float(width))
+        idx[data == bins_arr[-1]] = nr_bins - 1
+        idx[~((idx >= 0) & (idx < nr_bins))] = -1  # also catches nans
+        idx = idx.astype(np.min_scalar_type(-nr_bins))
+    else:
+        idx = np.digitize(data, bins_arr) - 1
+        idx[data == bins_arr[-1]] = nr_bins - 1
+        idx[idx >= nr_bins] = -1
+    return idx
+
+
 def map_ima_to_2D_hist(xinput, yinput, bins_arr):
     """Image to volume histogram mapping (kind of inverse histogram).
 
@@ -45,18 +87,24 @@ def map_ima_to_2D_hist(xinput, yinput, bins_arr):
     Returns
     -------
     vox2pixMap : TODO
-        Voxel to pixel mapping.
+        Voxel to pixel mapping. Voxels which do not fall into the histogram
+        are mapped to nr_bins**2 (one past the last pixel). The narrowest
+        unsigned integer type that can hold nr_bins**2 is used.
 
     """
-    dgtzData = np.digitize(xinput, bins_arr)-1
-    dgtzGra = np.digitize(yinput, bins_arr)-1
     nr_bins = len(bins_arr)-1  # subtract 1 (more borders than containers)
-    vox2pixMap = sub2ind(nr_bins, dgtzData, dgtzGra)  # 1D
+    dgtzData = compute_bin_indices(xinput, bins_arr)
+    dgtzGra = compute_bin_indices(yinput, bins_arr)
+    idx_out = (dgtzData < 0) | (dgtzGra < 0)
+    dgtzData[idx_out], dgtzGra[idx_out] = 0, nr_bins  # one past last pixel
+    dtype = np.min_scalar_type(nr_bins * nr_bins)
+    vox2pixMap = sub2ind(nr_bins, dgtzData.astype(dtype),
+                         dgtzGra.astype(dtype))  # 1D
     return vox2pixMap
 
 
 def map_2D_hist_to_ima(imaSlc2volHistMap, volHistMask):
-    """Volume histogram to image mapping for slices (uses np.ind1).
+    """Volume histogram to image mapping for slices (uses a lookup table).
 
     Parameters
     ----------
@@ -70,18 +118,198 @@ def map_2D_hist_to_ima(imaSlc2volHistMap, volHistMask):
     imaSlcMask : 1D numpy array
         Flat image slice mask based on labeled pixels in volume histogram.
 
+    Notes
+    -----
+    The flattened volume histogram mask is used as a lookup table, each voxel
+    gathers its label by indexing it with its bin. This is a single pass over
+    the voxels regardless of the number of labels. Voxels mapped outside of
+    the histogram are labeled with 0.
+
+    The GUIs use map_2D_hist_to_ima_indexed, which only visits the voxels of
+    labeled pixels. This function is kept as the reference implementation
+    that the tests check the indexed mapping against.
+
     """
-    imaSlcMask = np.zeros(imaSlc2volHistMap.shape)
-    idxUnique = np.unique(volHistMask)
-    for idx in idxUnique:
-        linIndices = np.where(volHistMask.flatten() == idx)[0]
-        # return logical array with length equal to nr of voxels
-        voxMask = np.in1d(imaSlc2volHistMap, linIndices)
-        # reset mask and apply logical indexing
-        imaSlcMask[voxMask] = idx
+    lut = np.ravel(volHistMask)
+    imaSlcMask = np.zeros(imaSlc2volHistMap.shape, dtype=cfg.dtype)
+    # ignore voxels which do not fall into any bin
+    idx_valid = (imaSlc2volHistMap >= 0) & (imaSlc2volHistMap < lut.size)
+    imaSlcMask[idx_valid] = lut[imaSlc2volHistMap[idx_valid]]
     return imaSlcMask
 
 
+def create_2D_hist_index(vox2pixMap, nr_bins, voxels=None, chunk_size=2**18):
+    """Volume histogram to image index (inverse of the voxel to pixel map).
+
+    Parameters
+    ----------
+    vox2pixMap : np.ndarray
+        Voxel to pixel mapping, see map_ima_to_2D_hist.
+    nr_bins : integer
+        Number of one dimensional bins (not the pixels).
+    voxels : 1D numpy array or None
+        Flat image indices of the voxels in vox2pixMap when it only holds
+        the foreground voxels, see find_foreground. Other voxels are not in
+        the index. None when vox2pixMap holds all voxels.
+    chunk_size : int
+        Number of voxels sorted at once, which bounds the temporary arrays.
+
+    Returns
+    -------
+    pix2voxIdx : 1D numpy array
+        Flat voxel indices sorted by their pixels.
+    pix2voxPtr : 1D numpy array, shape(nr_bins**2 + 2)
+        Pixel offsets (CSR format). Voxels of pixel i are stored in
+        pix2voxIdx[pix2voxPtr[i]:pix2voxPtr[i+1]]. The last pixel holds the
+        voxels which are out of the histogram.
+
+    """
+    vox2pixMap = np.ravel(vox2pixMap)
+    pix_counts = np.bincount(vox2pixMap, minlength=nr_bins*nr_bins + 1)
+    pix2voxPtr = np.zeros(pix_counts.size + 1, dtype=np.int64)
+    np.cumsum(pix_counts, out=pix2voxPtr[1:])
+    if voxels is None:
+        dtype = np.min_scalar_type(vox2pixMap.size)
+    else:
+        dtype = voxels.dtype
+    pix2voxIdx = np.empty(vox2pixMap.size, dtype=dtype)
+    # Counting sort, voxels of each chunk are scattered after the voxels of
+    # the same pixels in the previous chunks
+    fill = pix2voxPtr[:-1].copy()
+    for start in range(0, vox2pixMap.size, chunk_size):
+        pix = vox2pixMap[start:start + chunk_size]
+        order = argsort_pixels(pix)
+        pix_sorted = pix[order]
+        counts = np.bincount(pix, minlength=pix_counts.size)
+        chunk_ptr = np.cumsum(counts) - counts
+        dest = fill[pix_sorted] - chunk_ptr[pix_sorted]
+        dest += np.arange(pix.size)
+        order += start
+        pix2voxIdx[dest] = order if voxels is None else voxels[order]
+        fill += counts
+    return pix2voxIdx, pix2voxPtr
+
+
+def argsort_pixels(pix):
+    """Stable argsort of pixel indices with 16 bit radix sorts.
+
+    Parameters
+    ----------
+    pix : 1D numpy array, non-negative integers below 2**32
+
+    Returns
+    -------
+    order : 1D numpy array
+
+    """
+    order = np.argsort((pix & 0xFFFF).astype(np.uint16), kind='stable')
+    if pix.size > 0 and pix.max() > 0xFFFF:
+        high = (pix[order] >> 16).astype(np.uint16)
+        order = order[np.argsort(high, kind='stable')]
+    return order
+
+
+def get_pixel_voxels(pix2voxIdx, pix2voxPtr, pixels):
+    """Find voxels of selected pixels using the volume histogram index.
+
+    Parameters
+    ----------
+    pix2voxIdx : 1D numpy array
+        Flat voxel indices sorted by their pixels, see create_2D_hist_index.
+    pix2voxPtr : 1D numpy array
+        Pixel offsets, see create_2D_hist_index.
+    pixels : 1D numpy array
+        Linear indices of the selected pixels.
+
+    Returns
+    -------
+    voxels : 1D numpy array
+        Flat voxel indices of the selected pixels (grouped by pixel).
+    nr_voxels : 1D numpy array
+        Number of voxels in each selected pixel.
+
+    """
+    starts = pix2voxPtr[pixels]
+    nr_voxels = pix2voxPtr[pixels + 1] - starts
+    # concatenate index ranges without a python loop
+    ends = np.cumsum(nr_voxels)
+    idx = np.repeat(starts - (ends - nr_voxels), nr_voxels)
+    idx += np.arange(idx.size)
+    return pix2voxIdx[idx], nr_voxels
+
+
+def map_2D_hist_to_ima_indexed(pix2voxIdx, pix2voxPtr, volHistMask, nr_vox,
+                               dtype=None):
+    """Volume histogram to image mapping using the volume histogram index.
+
+    Parameters
+    ----------
+    pix2voxIdx : 1D numpy array
+        Flat voxel indices sorted by their pixels, see create_2D_hist_index.
+    pix2voxPtr : 1D numpy array
+        Pixel offsets, see create_2D_hist_index.
+    volHistMask : numpy array
+        Volume histogram mask.
+    nr_vox : integer
+        Number of voxels in the image (or image slice).
+    dtype : string or np.dtype
+        Data type of the image mask, working precision (config.dtype) when
+        None. See get_label_dtype for exports.
+
+    Returns
+    -------
+    imaMask : 1D numpy array
+        Flat image mask based on labeled pixels in volume histogram.
+
+    Notes
+    -----
+    Only the voxels of labeled (non-zero) pixels are visited, which makes
+    small selections cheap regardless of the image size.
+
+    """
+    lut = np.ravel(volHistMask)
+    imaMask = np.zeros(nr_vox, dtype=cfg.dtype if dtype is None else dtype)
+    pixels = np.flatnonzero(lut)
+    voxels, nr_voxels = get_pixel_voxels(pix2voxIdx, pix2voxPtr, pixels)
+    imaMask[voxels] = np.repeat(lut[pixels], nr_voxels)
+    return imaMask
+
+
+def relabel(labels):
+    """Assign consecutive integers to the unique labels.
+
+    Parameters
+    ----------
+    labels : np.ndarray
+        Labels, eg. a volume histogram mask.
+
+    Returns
+    -------
+    out : np.ndarray
+        Labels from 0 (smallest label) to the number of unique labels - 1.
+
+    """
+    _, out = np.unique(labels, return_inverse=True)
+    return out.reshape(np.shape(labels))
+
+
+def get_label_dtype(max_label):
+    """Find the smallest unsigned integer type that holds the labels.
+
+    Parameters
+    ----------
+    max_label : int
+        Largest label.
+
+    Returns
+    -------
+    dtype : np.dtype
+        uint8, uint16, uint32 or uint64.
+
+    """
+    return np.min_scalar_type(max(int(max_label), 0))
+
+
 def truncate_range(data, percMin=0.25, percMax=99.75, discard_zeros=True):
     """Truncate too low and too high values.
 
@@ -153,17 +381,342 @@ def scale_range(data, scale_factor=500, delta=0, discard_zeros=True):
     return data
 
 
-def check_data(data, force_original_precision=True):
-    """Do type casting here."""
-    data = np.squeeze(data)  # to prevent singular dimension error
-    dims = data.shape
-    print('Input image data type is {}.'.format(data.dtype.name))
-    if force_original_precision:
-        pass
-    elif data.dtype != 'float32':
-        data = data.astype('float32')
-        print('  Data type is casted to {}.'.format(data.dtype.name))
-    return data, dims
+def _iter_chunks(flat, chunk_size):
+    """Iterate over views of consecutive chunks of a flat array."""
+    for i in range(0, flat.size, chunk_size):
+        yield flat[i:i + chunk_size]
+
+
+def _valid_values(chunk, discard_zeros=True):
+    """Return values that count towards the data range (no nans, zeros)."""
+    if discard_zeros:
+        return chunk[np.abs(chunk) > 1e-8]  # same as ~np.isclose(chunk, 0)
+    return chunk[~np.isnan(chunk)]
+
+
+def data_range(data, discard_zeros=True, chunk_size=2**22):
+    """Find minimum and maximum in a single streaming pass.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Input image.
+    discard_zeros : bool
+        Discard voxels with value 0.
+    chunk_size : int
+        Number of voxels that are processed at once.
+
+    Returns
+    -------
+    data_min : float
+        Minimum value (nans are discarded).
+    data_max : float
+        Maximum value (nans are discarded).
+
+    """
+    return _chunks_range(_iter_chunks(np.ravel(data), chunk_size),
+                         discard_zeros)
+
+
+def _chunks_range(chunks, discard_zeros=True):
+    """Find minimum and maximum of consecutive chunks of data."""
+    data_min, data_max = np.inf, -np.inf
+    for chunk in chunks:
+        values = _valid_values(chunk, discard_zeros)
+        if values.size > 0:
+            data_min = min(data_min, float(np.min(values)))
+            data_max = max(data_max, float(np.max(values)))
+    return data_min, data_max
+
+
+def prep_percentile_sketch(data, discard_zeros=True, exact=True,
+                           nr_bins=2**16, chunk_size=2**22):
+    """Prepare a sketch of the data for fast percentile lookups.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Image to be truncated later on.
+    discard_zeros : bool
+        Discard voxels with value 0 from the sketch.
+    exact : bool
+        If True, the sketch is a sorted copy of the data. Otherwise the data
+        is streamed in chunks into a fine histogram, which needs little memory
+        and is accurate up to one histogram bin width.
+    nr_bins : int
+        Number of histogram bins, only used if exact is False.
+    chunk_size : int
+        Number of voxels that are processed at once, only used if exact is
+        False.
+
+    Returns
+    -------
+    sketch : 1D np.ndarray or tuple
+        Sorted values (nans are discarded) or a tuple of histogram bin edges
+        and counts.
+
+    """
+    if exact:
+        return np.sort(_valid_values(np.ravel(data), discard_zeros))
+    return stream_percentile_sketch(
+        lambda: _iter_chunks(np.ravel(data), chunk_size), discard_zeros,
+        nr_bins)
+
+
+def stream_percentile_sketch(iter_chunks, discard_zeros=True, nr_bins=2**16):
+    """Prepare a histogram sketch of data that does not fit in memory.
+
+    Parameters
+    ----------
+    iter_chunks : callable
+        Returns a new iterator over consecutive chunks of the data. Data is
+        iterated twice, once for the range and once for the counts.
+    discard_zeros : bool
+        Discard voxels with value 0 from the sketch.
+    nr_bins : int
+        Number of histogram bins.
+
+    Returns
+    -------
+    sketch : tuple
+        Histogram bin edges and counts, see prep_percentile_sketch.
+
+    """
+    data_min, data_max = _chunks_range(iter_chunks(), discard_zeros)
+    if data_max < data_min:  # no valid values
+        return np.array([data_min, data_max]), np.zeros(1, dtype=np.int64)
+    if data_max == data_min:
+        nr_bins = 1
+    counts = np.zeros(nr_bins, dtype=np.int64)
+    for chunk in iter_chunks():
+        counts += np.histogram(_valid_values(chunk, discard_zeros),
+                               bins=nr_bins, range=(data_min, data_max))[0]
+    bin_edges = np.linspace(data_min, data_max, nr_bins + 1)
+    return bin_edges, counts
+
+
+def sketch_range(sketch):
+    """Minimum and maximum of the values summarized by a sketch."""
+    if isinstance(sketch, tuple):
+        return sketch[0][0], sketch[0][-1]
+    return sketch[0], sketch[-1]
+
+
+def sketch_percentile(sketch, percs):
+    """Look up percentiles from a sketch (similar to np.percentile).
+
+    Parameters
+    ----------
+    sketch : 1D np.ndarray or tuple
+        Sorted values or histogram, see prep_percentile_sketch.
+    percs : float or list
+        Percentiles between 0 and 100.
+
+    Returns
+    -------
+    values : float or np.ndarray
+        Percentile values (linear interpolation between closest ranks).
+
+    """
+    if isinstance(sketch, tuple):  # histogram sketch
+        bin_edges, counts = sketch
+        cum_counts = np.cumsum(counts)
+        pos = np.asarray(percs, dtype=float) / 100. * (cum_counts[-1] - 1)
+        idx = np.minimum(np.searchsorted(cum_counts, pos, side='right'),
+                         counts.size - 1)
+        prev = cum_counts[idx] - counts[idx]
+        frac = (pos - prev) / np.maximum(counts[idx], 1)
+        values = bin_edges[idx] + frac * (bin_edges[idx + 1] - bin_edges[idx])
+        return np.clip(values, bin_edges[0], bin_edges[-1])
+    pos = np.asarray(percs, dtype=float) / 100. * (sketch.size - 1)
+    idx_lo = np.floor(pos).astype(int)
+    idx_hi = np.minimum(idx_lo + 1, sketch.size - 1)
+    val_lo = sketch[idx_lo].astype(float)
+    val_hi = sketch[idx_hi].astype(float)
+    return val_lo + (val_hi - val_lo) * (pos - idx_lo)
+
+
+def truncate_scale_range(data, pMin, pMax, scale_factor=500, delta=0,
+                         discard_zeros=True, data_min=None, data_max=None,
+                         inplace=False, chunk_size=2**22):
+    """Truncate and scale in a single streaming pass.
+
+    Same as truncate_range with given thresholds followed by scale_range.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Image to be truncated and scaled.
+    pMin : float
+        Minimum truncation threshold.
+    pMax : float
+        Maximum truncation threshold.
+    scale_factor : float
+        Truncated data is scaled between 0 to this number.
+    delta : float
+        Delta ensures that the max data points fall inside the last bin
+        when this function is used with histograms.
+    discard_zeros : bool
+        Discard voxels with value 0 from truncation and scaling.
+    data_min, data_max : float
+        Range of the data before truncation (see data_range). Computed with
+        an extra pass over the data when not given.
+    inplace : bool
+        Modify the data instead of a copy (only if data is contiguous).
+    chunk_size : int
+        Number of voxels that are processed at once.
+
+    Returns
+    -------
+    out : np.ndarray
+        Truncated and scaled image.
+    factor : float
+        Multiplier used in scaling, useful to scale derived images (such as
+        gradient magnitude) in the same way.
+
+    """
+    if data_min is None or data_max is None:
+        data_min, data_max = data_range(data, discard_zeros, chunk_size)
+    data_min, data_max = max(pMin, data_min), min(pMax, data_max)
+    factor = (scale_factor - delta) / (data_max - data_min)
+    if not np.issubdtype(data.dtype, np.floating):
+        out = data.astype(cfg.dtype)
+    elif inplace and data.flags.c_contiguous:
+        out = data
+    else:
+        out = np.array(data, order='C')
+    # thresholds in the precision of the image, so that voxels clipped to the
+    # minimum become exactly 0
+    pMin, pMax, offset = (out.dtype.type(v) for v in (pMin, pMax, data_min))
+    for chunk in _iter_chunks(out.reshape(-1), chunk_size):
+        if discard_zeros:
+            msk = np.abs(chunk) <= 1e-8  # same as np.isclose(chunk, 0)
+        np.clip(chunk, pMin, pMax, out=chunk)
+        chunk -= offset
+        chunk *= factor
+        if discard_zeros:
+            chunk[msk] = 0  # put back masked out voxels
+    return out, factor
+
+
+def preprocess_range(data, percMin=2.5, percMax=97.5, scale_factor=500,
+                     delta=0, valmin=np.nan, valmax=np.nan,
+                     discard_zeros=True, exact=False, mask=None):
+    """Truncate and scale the data range in place.
+
+    Fused replacement of truncate_range followed by scale_range. Percentiles
+    are estimated with a streaming histogram unless exact is True.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Image to be truncated and scaled, modified in place when possible.
+    percMin : float
+        Minimum percentile to be truncated.
+    percMax : float
+        Maximum percentile to be truncated.
+    scale_factor : float
+        Truncated data is scaled between 0 to this number.
+    delta : float
+        Delta ensures that the max data points fall inside the last bin
+        when this function is used with histograms.
+    valmin, valmax : float
+        Truncation thresholds, overwrite the percentiles when not nan.
+    discard_zeros : bool
+        Discard voxels with value 0 from truncation and scaling.
+    exact : bool
+        Use exact percentiles (sorts a copy of the data).
+    mask : np.ndarray or None
+        Boolean image, only these voxels are used for the percentiles and the
+        data range. All voxels are truncated and scaled.
+
+    Returns
+    -------
+    data : np.ndarray
+        Truncated and scaled image.
+    pMin : float
+        Minimum truncation threshold which is used.
+    pMax : float
+        Maximum truncation threshold which is used.
+
+    """
+    values = data if mask is None else data[mask]
+    if np.isnan(valmin) or np.isnan(valmax):
+        sketch = prep_percentile_sketch(values, discard_zeros, exact)
+        pMin, pMax = sketch_percentile(sketch, [percMin, percMax])
+        data_min, data_max = sketch_range(sketch)
+        del sketch
+    else:
+        data_min, data_max = data_range(values, discard_zeros)
+    del values
+    if not np.isnan(valmin):
+        pMin = valmin
+    if not np.isnan(valmax):
+        pMax = valmax
+    data, _ = truncate_scale_range(
+        data, pMin, pMax, scale_factor=scale_factor, delta=delta,
+        discard_zeros=discard_zeros, data_min=data_min, data_max=data_max,
+        inplace=True)
+    return data, pMin, pMax
+
+
+def find_crop(data, margin=2):
+    """Find the bounding box of non-zero voxels.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Image, often skull stripped and mostly zeros.
+    margin : int
+        Number of voxels added around the bounding box (within the image).
+        Keeps the neighbours of non-zero voxels for gradient computations.
+
+    Returns
+    -------
+    crop : tuple of slices
+        Bounding box, data[crop] is the cropped image. Whole image if there
+        are no non-zero voxels.
+
+    """
+    nonzero = np.abs(data) > 1e-8  # same as np.isclose(data, 0)
+    crop = []
+    for axis in range(data.ndim):
+        other_axes = tuple(a for a in range(data.ndim) if a != axis)
+        idx = np.flatnonzero(np.any(nonzero, axis=other_axes))
+        if idx.size == 0:
+            return tuple(slice(0, n) for n in data.shape)
+        crop.append(slice(max(idx[0] - margin, 0),
+                          min(idx[-1] + 1 + margin, data.shape[axis])))
+    return tuple(crop)
+
+
+def uncrop(data, crop, shape, background=None):
+    """Pad a cropped image back to the original grid.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Cropped image.
+    crop : tuple of slices
+        Bounding box, see find_crop.
+    shape : tuple
+        Shape of the original image.
+    background : np.ndarray or None
+        Values outside of the bounding box, eg. the original image. None
+        pads with zeros.
+
+    Returns
+    -------
+    out : np.ndarray
+        Image with the original shape.
+
+    """
+    if background is None:
+        out = np.zeros(shape, dtype=data.dtype)
+    else:
+        out = np.array(background, dtype=data.dtype).reshape(shape)
+    out[crop] = data
+    return out
 
 
 def prep_2D_hist(ima, gra, discard_zeros=True):
@@ -176,32 +729,390 @@ def prep_2D_hist(ima, gra, discard_zeros=True):
     gra : np.ndarray
         Second image, which is often the gradient magnitude image
         derived from the first image.
+    discard_zeros : bool
+        Discard voxels with value 0 from the histogram counts.
 
     Returns
     -------
-    counts : integer
-    volHistH : TODO
+    counts : np.ndarray, shape(nr_bins, nr_bins)
+        2D histogram counts. First axis is the first image, second axis is
+        the second image (same as np.histogram2d).
+    vox2pixMap : np.ndarray
+        Voxel to pixel mapping of all voxels, see map_ima_to_2D_hist.
     d_min : float
         Minimum of the first image.
     d_max : float
         Maximum of the first image.
     nr_bins : integer
         Number of one dimensional bins (not the pixels).
-    bin_edges : TODO
+    bin_edges : np.ndarray
+        Edges of the one dimensional bins.
 
     Notes
     -----
-    This function is modularized to be called from the terminal.
+    This function is modularized to be called from the terminal. It does not
+    create any plots, use gui_utils.plot_2D_hist to display the counts.
 
     """
     if discard_zeros:
-        gra = gra[~np.isclose(ima, 0)]
-        ima = ima[~np.isclose(ima, 0)]
-    d_min, d_max = np.round(np.nanpercentile(ima, [0, 100]))
+        idx_nonzero = ~np.isclose(ima, 0)
+        d_min = np.round(np.nanmin(ima[idx_nonzero]))
+        d_max = np.round(np.nanmax(ima[idx_nonzero]))
+    else:
+        d_min, d_max = np.round(np.nanmin(ima)), np.round(np.nanmax(ima))
     nr_bins = int(d_max - d_min)
     bin_edges = np.arange(d_min, d_max+1)
-    counts, _, _, volHistH = plt.hist2d(ima, gra, bins=bin_edges, cmap='Greys')
-    return counts, volHistH, d_min, d_max, nr_bins, bin_edges
+    # counts are derived from the voxel to pixel mapping (single binning pass)
+    vox2pixMap = map_ima_to_2D_hist(ima, gra, bin_edges)
+    if discard_zeros:
+        counts = np.bincount(vox2pixMap[idx_nonzero],
+                             minlength=nr_bins*nr_bins + 1)
+    else:
+        counts = np.bincount(vox2pixMap, minlength=nr_bins*nr_bins + 1)
+    # drop out of histogram voxels, swap axes to have first image on rows
+    counts = counts[:-1].reshape(nr_bins, nr_bins).T
+    return counts, vox2pixMap, d_min, d_max, nr_bins, bin_edges
+
+
+def prep_ND_hist(features, discard_zeros=True):
+    """Prepare a sparse joint histogram of several images.
+
+    Parameters
+    ----------
+    features : list of np.ndarray
+        Images with the same number of voxels. First image is often the
+        intensity image, it determines the bins of all images (same as
+        prep_2D_hist).
+    discard_zeros : bool
+        Discard voxels with value 0 in the first image from the counts.
+
+    Returns
+    -------
+    bins : np.ndarray, shape(nr_features, nr_nonempty)
+        Bin coordinates of the non-empty joint histogram bins (COO format).
+        Values outside of the bins of an image (or nan) have the coordinate
+        nr_bins on its axis.
+    counts : 1D np.ndarray
+        Counts of the non-empty bins.
+    vox2binMap : 1D np.ndarray
+        Voxel to non-empty bin mapping.
+    d_min : float
+        Minimum of the first image.
+    d_max : float
+        Maximum of the first image.
+    nr_bins : integer
+        Number of one dimensional bins.
+    bin_edges : np.ndarray
+        Edges of the one dimensional bins.
+
+    Notes
+    -----
+    Only the non-empty bins are stored, a dense histogram would need
+    nr_bins**nr_features cells. Use project_ND_hist to get 2D views.
+
+    """
+    ima = np.ravel(features[0])
+    if discard_zeros:
+        idx_nonzero = ~np.isclose(ima, 0)
+        d_min = np.round(np.nanmin(ima[idx_nonzero]))
+        d_max = np.round(np.nanmax(ima[idx_nonzero]))
+    else:
+        d_min, d_max = np.round(np.nanmin(ima)), np.round(np.nanmax(ima))
+    nr_bins = int(d_max - d_min)
+    bin_edges = np.arange(d_min, d_max+1)
+    # joint bin index of every voxel, values outside of the bins of an image
+    # are put in an extra bin so that projections keep them out of the view
+    shape = [nr_bins + 1] * len(features)
+    dgtz = []
+    for feature in features:
+        idx = compute_bin_indices(np.ravel(feature), bin_edges)
+        idx = idx.astype(np.min_scalar_type(nr_bins))  # -1 wraps around
+        idx[idx > nr_bins] = nr_bins
+        dgtz.append(idx)
+    lin_bins, vox2binMap = np.unique(np.ravel_multi_index(dgtz, shape),
+                                     return_inverse=True)
+    del dgtz
+    bins = np.array(np.unravel_index(lin_bins, shape),
+                    dtype=np.min_scalar_type(nr_bins))
+    vox2binMap = np.ravel(vox2binMap).astype(
+        np.min_scalar_type(lin_bins.size))
+    if discard_zeros:
+        counts = np.bincount(vox2binMap[idx_nonzero],
+                             minlength=lin_bins.size)
+    else:
+        counts = np.bincount(vox2binMap, minlength=lin_bins.size)
+    return bins, counts, vox2binMap, d_min, d_max, nr_bins, bin_edges
+
+
+def project_ND_hist(bins, counts, vox2binMap, nr_bins, axes=(0, 1)):
+    """Project a sparse joint histogram onto two of its axes.
+
+    Parameters
+    ----------
+    bins : np.ndarray, shape(nr_features, nr_nonempty)
+        Bin coordinates of the non-empty bins, see prep_ND_hist.
+    counts : 1D np.ndarray
+        Counts of the non-empty bins.
+    vox2binMap : 1D np.ndarray
+        Voxel to non-empty bin mapping.
+    nr_bins : integer
+        Number of one dimensional bins.
+    axes : tuple
+        Features shown on the first and second axes of the 2D histogram.
+
+    Returns
+    -------
+    counts2D : np.ndarray, shape(nr_bins, nr_bins)
+        2D histogram counts, same as prep_2D_hist of the two features.
+    vox2pixMap : np.ndarray
+        Voxel to pixel mapping, same as map_ima_to_2D_hist of the two
+        features.
+
+    """
+    xbins = bins[axes[0]].astype(np.int64)
+    ybins = bins[axes[1]].astype(np.int64)
+    pixels = sub2ind(nr_bins, xbins, ybins)
+    # out of histogram bins are mapped to one past the last pixel
+    pixels[(xbins == nr_bins) | (ybins == nr_bins)] = nr_bins*nr_bins
+    pixels = pixels.astype(np.min_scalar_type(nr_bins*nr_bins))
+    counts2D = np.bincount(pixels, weights=counts,
+                           minlength=nr_bins*nr_bins + 1)
+    counts2D = counts2D[:-1].astype(np.int64).reshape(nr_bins, nr_bins).T
+    return counts2D, pixels[vox2binMap]
+
+
+def prep_2D_hist_projection(ima, gra, extra_features=[], axes=(0, 1),
+                            discard_zeros=True):
+    """Prepare the 2D histogram of two images out of several.
+
+    Parameters
+    ----------
+    ima : np.ndarray
+        First image, which is often the intensity image (eg. T1w).
+    gra : np.ndarray
+        Second image, which is often the gradient magnitude image
+        derived from the first image.
+    extra_features : list of np.ndarray
+        Additional images, see load_extra_features.
+    axes : tuple
+        Images shown on the axes of the 2D histogram. 0 is the first image,
+        1 the second image and 2 and up the extra features.
+    discard_zeros : bool
+        Discard voxels with value 0 from the histogram counts.
+
+    Returns
+    -------
+    Same as prep_2D_hist.
+
+    """
+    if not extra_features and tuple(axes) == (0, 1):
+        return prep_2D_hist(ima, gra, discard_zeros=discard_zeros)
+    bins, counts, vox2binMap, d_min, d_max, nr_bins, bin_edges = \
+        prep_ND_hist([ima, gra] + list(extra_features),
+                     discard_zeros=discard_zeros)
+    counts, vox2pixMap = project_ND_hist(bins, counts, vox2binMap, nr_bins,
+                                         axes=axes)
+    return counts, vox2pixMap, d_min, d_max, nr_bins, bin_edges
+
+
+def prep_2D_hist_foreground(ima, gra, fg_idx=None, extra_features=[],
+                            axes=(0, 1), discard_zeros=True):
+    """Prepare the 2D histogram and its index from the foreground voxels.
+
+    Parameters
+    ----------
+    ima : np.ndarray
+        First image (all voxels).
+    gra : 1D np.ndarray
+        Second image, foreground voxels only (in the order of fg_idx).
+    fg_idx : 1D np.ndarray or None
+        Flat indices of the foreground voxels, see find_foreground. None
+        uses all voxels.
+    extra_features : list of 1D np.ndarray
+        Additional images, foreground voxels only.
+    axes : tuple
+        Images shown on the axes of the 2D histogram, see
+        prep_2D_hist_projection.
+    discard_zeros : bool
+        Discard voxels with value 0 from the histogram counts.
+
+    Returns
+    -------
+    counts : np.ndarray, shape(nr_bins, nr_bins)
+        2D histogram counts, see prep_2D_hist.
+    vox2pixMap : np.ndarray
+        Voxel to pixel mapping of all voxels. Background voxels are out of
+        the histogram (pixel nr_bins**2).
+    pix2voxIdx, pix2voxPtr : 1D np.ndarray
+        Volume histogram index of the foreground voxels, see
+        create_2D_hist_index.
+    d_min, d_max, nr_bins, bin_edges
+        Same as prep_2D_hist.
+
+    """
+    ima = np.ravel(ima)
+    if fg_idx is None:
+        counts, vox2pixMap, d_min, d_max, nr_bins, bin_edges = \
+            prep_2D_hist_projection(ima, gra, extra_features, axes,
+                                    discard_zeros)
+        pix2voxIdx, pix2voxPtr = create_2D_hist_index(vox2pixMap, nr_bins)
+    else:
+        counts, fg_map, d_min, d_max, nr_bins, bin_edges = \
+            prep_2D_hist_projection(ima[fg_idx], gra, extra_features, axes,
+                                    discard_zeros)
+        pix2voxIdx, pix2voxPtr = create_2D_hist_index(fg_map, nr_bins,
+                                                      voxels=fg_idx)
+        vox2pixMap = np.full(ima.size, nr_bins*nr_bins, dtype=fg_map.dtype)
+        vox2pixMap[fg_idx] = fg_map
+    return (counts, vox2pixMap, pix2voxIdx, pix2voxPtr, d_min, d_max, nr_bins,
+            bin_edges)
+
+
+def load_mask(path, dims, crop=None):
+    """Load a binary mask of the foreground voxels (eg. brain mask).
+
+    Parameters
+    ----------
+    path : string
+        Path to a nifti file, non-zero voxels are foreground.
+    dims : tuple
+        Shape of the first image (before cropping).
+    crop : tuple of slices or None
+        Bounding box of the first image, see find_crop.
+
+    Returns
+    -------
+    mask : np.ndarray
+        Boolean image.
+
+    """
+    print('Loading mask {}'.format(path))
+    data, _ = load_data(load_nifti(path), dtype=cfg.dtype)
+    if data.shape != tuple(dims):
+        raise ValueError('Mask {} does not have the same dimensions as the '
+                         'input image.'.format(path))
+    mask = ~np.isclose(data, 0)
+    if crop is not None:
+        mask = np.ascontiguousarray(mask[crop])
+    return mask
+
+
+def find_foreground(ima, mask=None, discard_zeros=True):
+    """Find the voxels which are used in the histogram.
+
+    Parameters
+    ----------
+    ima : np.ndarray
+        First image.
+    mask : np.ndarray or None
+        Boolean image, see load_mask.
+    discard_zeros : bool
+        Voxels with value 0 are background.
+
+    Returns
+    -------
+    fg_idx : 1D np.ndarray or None
+        Flat indices of the foreground voxels. None if all voxels are used.
+
+    """
+    if mask is None and not discard_zeros:
+        return None
+    foreground = np.ones(ima.size, dtype=bool)
+    if discard_zeros:
+        foreground = ~np.isclose(np.ravel(ima), 0)
+    if mask is not None:
+        foreground &= np.ravel(mask)
+    return np.flatnonzero(foreground).astype(np.min_scalar_type(ima.size))
+
+
+def load_extra_features(paths, nr_voxels, crop=None):
+    """Load extra images and truncate and scale them like the first image.
+
+    Parameters
+    ----------
+    paths : list of strings
+        Paths to nifti files, eg. other contrasts of the same subject.
+    nr_voxels : int
+        Number of voxels in the first image (before cropping).
+    crop : tuple of slices or None
+        Bounding box of the first image, see find_crop. Applied after the
+        range of the whole extra image is truncated and scaled.
+
+    Returns
+    -------
+    features : list of 1D np.ndarray
+        Truncated and scaled images.
+
+    """
+    features = []
+    for path in paths:
+        print('Loading extra feature {}'.format(path))
+        data, _ = load_data(load_nifti(path), cfg.force_original_precision,
+                            cfg.dtype)
+        if data.size != nr_voxels:
+            raise ValueError('Extra feature {} does not have the same number '
+                             'of voxels as the input image.'.format(path))
+        data, _, _ = preprocess_range(
+            data, percMin=cfg.perc_min, percMax=cfg.perc_max,
+            scale_factor=cfg.scale, delta=0.0001, exact=cfg.exact_percentiles)
+        if crop is not None:
+            data = data[crop]
+        features.append(data.ravel())
+    return features
+
+
+def prep_2D_hist_moments(counts, bin_edges):
+    """Prepare moment images of the 2D histogram for selection statistics.
+
+    Parameters
+    ----------
+    counts : np.ndarray, shape(nr_bins, nr_bins)
+        2D histogram counts, see prep_2D_hist.
+    bin_edges : np.ndarray
+        Bin edges of both images, see prep_2D_hist.
+
+    Returns
+    -------
+    moments : np.ndarray, shape(3, nr_bins*nr_bins)
+        Voxel counts, summed first image values and summed second image
+        values (approximated by bin centers) of every histogram pixel. Pixels
+        are flattened in the same order as the volume histogram mask.
+
+    """
+    centers = bin_edges[:-1] + 0.5 * np.diff(bin_edges)
+    nr_vox = counts.T.astype('float64')  # same orientation as the mask
+    moments = np.stack([nr_vox,
+                        nr_vox * centers[np.newaxis, :],
+                        nr_vox * centers[:, np.newaxis]])
+    return moments.reshape(3, -1)
+
+
+def selection_stats(moments, selection):
+    """Compute statistics of the voxels selected in the 2D histogram.
+
+    Only the histogram pixels are visited, never the image voxels.
+
+    Parameters
+    ----------
+    moments : np.ndarray, shape(3, nr_bins*nr_bins)
+        Moment images, see prep_2D_hist_moments.
+    selection : 1D np.ndarray
+        Flat boolean volume histogram mask.
+
+    Returns
+    -------
+    nr_vox : int
+        Number of selected voxels.
+    mean_ima : float
+        Mean of the selected voxels in the first image.
+    mean_gra : float
+        Mean of the selected voxels in the second image.
+
+    """
+    nr_vox, sum_ima, sum_gra = np.dot(moments, selection.astype('float64'))
+    if nr_vox == 0:
+        return 0, np.nan, np.nan
+    return int(nr_vox), sum_ima / nr_vox, sum_gra / nr_vox
 
 
 def create_3D_kernel(operator='scharr'):
@@ -232,18 +1143,273 @@ def create_3D_kernel(operator='scharr'):
                              [[0, 0, 0], [0, 0, 0], [0, 0, 0]],
                              [[-9, -30, -9], [-30, -100, -30], [-9, -30, -9]]],
                             dtype='float32')
+    operator = np.asarray(operator, dtype=cfg.dtype)
     scale_normalization_factor = np.sum(np.abs(operator))
     operator = np.divide(operator, scale_normalization_factor)
 
     # create permutations operator that will be used in gradient computation
-    kernel = np.zeros([3, 3, 3, 3])
+    kernel = np.zeros([3, 3, 3, 3], dtype=cfg.dtype)
     kernel[0, ...] = operator
     kernel[1, ...] = np.transpose(kernel[0, ...], [2, 0, 1])
     kernel[2, ...] = np.transpose(kernel[0, ...], [1, 2, 0])
     return kernel
 
 
-def compute_gradient_magnitude(ima, method='scharr'):
+def compute_separable_gradient_magnitude(ima, operator='scharr'):
+    """Compute gradient magnitude with separable 3D kernels.
+
+    The kernels of create_3D_kernel are the outer products of a derivative
+    ([1, 0, -1]) and two smoothing kernels, so each gradient is computed
+    with three 1D convolutions instead of one 3D convolution. Squared
+    gradients are accumulated in place.
+
+    Parameters
+    ----------
+    ima : np.ndarray
+        Image, its data type is used for the gradient magnitude.
+    operator : string
+        'scharr', 'sobel' or 'prewitt'.
+
+    Returns
+    -------
+    gra_mag : np.ndarray
+        Gradient magnitude, same as convolving with create_3D_kernel and
+        sqrt(sum(gradients**2) * 2).
+
+    """
+    smooth = {'scharr': [3, 10, 3], 'sobel': [1, 2, 1],
+              'prewitt': [1, 1, 1]}[operator]
+    smooth = np.asarray(smooth, dtype=ima.dtype)
+    derivative = np.asarray([1, 0, -1], dtype=ima.dtype)
+    normalization = np.sum(np.abs(derivative)) * np.sum(smooth)**2
+    gra_mag = np.zeros_like(ima)
+    temp1, temp2 = np.empty_like(ima), np.empty_like(ima)
+    for axis in range(ima.ndim):
+        convolve1d(ima, derivative, axis=axis, output=temp1)
+        for other_axis in range(ima.ndim):
+            if other_axis != axis:  # smooth along the other axes
+                convolve1d(temp1, smooth, axis=other_axis, output=temp2)
+                temp1, temp2 = temp2, temp1
+        np.square(temp1, out=temp1)
+        gra_mag += temp1
+    gra_mag *= 2. / normalization**2
+    return np.sqrt(gra_mag, out=gra_mag)
+
+
+def compute_local_gradient_magnitude(ima, method='scharr'):
+    """Compute gradient magnitude with one voxel neighbourhoods.
+
+    Parameters
+    ----------
+    ima : np.ndarray
+        Intensity image.
+    method : string
+        One of 'scharr', 'sobel', 'prewitt', 'numpy'.
+
+    Returns
+    -------
+    gra_mag : np.ndarray
+        Gradient magnitude image.
+
+    """
+    if method == 'numpy':
+        gra = np.asarray(np.gradient(ima))
+        return np.sqrt(np.sum(np.power(gra, 2.), axis=0))
+    return compute_separable_gradient_magnitude(ima, operator=method)
+
+
+def compute_slab_gradient_magnitude(ima, method='scharr', nr_threads=0,
+                                    slab_depth=None):
+    """Compute gradient magnitude of z-slabs in a thread pool.
+
+    Every output voxel only depends on its 3x3x3 neighbourhood, so each slab
+    is padded with one voxel of halo from its neighbours and only the core
+    of the slab is written to the output. The result is bit-identical to
+    compute_local_gradient_magnitude on the whole image. The scipy.ndimage
+    filters and the numpy arithmetic release the GIL, which lets the slabs
+    run concurrently.
+
+    Parameters
+    ----------
+    ima : np.ndarray, 3D
+        Intensity image.
+    method : string
+        One of 'scharr', 'sobel', 'prewitt', 'numpy'.
+    nr_threads : int
+        Number of threads. 0 uses all available cores.
+    slab_depth : int or None
+        Number of slices per slab. None splits the image into a few slabs
+        per thread, of at least 16 slices so that the halo adds little work.
+
+    Returns
+    -------
+    gra_mag : np.ndarray
+        Gradient magnitude image.
+
+    """
+    nr_threads = nr_threads if nr_threads > 0 else cpu_count()
+    nr_slices = ima.shape[2]
+    if slab_depth is None:
+        slab_depth = max(-(-nr_slices // (4 * nr_threads)), 16)
+    slab_depth = max(int(slab_depth), 1)
+    if nr_threads == 1 or slab_depth >= nr_slices:
+        return compute_local_gradient_magnitude(ima, method)
+    gra_mag = np.empty(ima.shape, dtype=ima.dtype)
+
+    def compute_slab(start):
+        stop = min(start + slab_depth, nr_slices)
+        first, last = max(start - 1, 0), min(stop + 1, nr_slices)
+        slab = compute_local_gradient_magnitude(ima[:, :, first:last], method)
+        gra_mag[:, :, start:stop] = slab[:, :, start-first:stop-first]
+
+    with ThreadPoolExecutor(nr_threads) as pool:
+        list(pool.map(compute_slab, range(0, nr_slices, slab_depth)))
+    return gra_mag
+
+
+def gaussian_kernel1d(sigma, order, radius):
+    """Sampled Gaussian (order 0) or Gaussian derivative (order 1) kernel.
+
+    Same kernels as scipy.ndimage.gaussian_filter1d, to be convolved with.
+    """
+    x = np.arange(-radius, radius + 1)
+    phi = np.exp(-0.5 / sigma**2 * x**2)
+    phi /= phi.sum()
+    return -x / sigma**2 * phi if order == 1 else phi
+
+
+def iter_gaussian_gradients_fft(ima, sigmas, nr_threads=0):
+    """Gaussian derivatives along each axis with FFT convolutions.
+
+    The image is padded with its mirrored borders by the kernel radius, so
+    the result matches scipy.ndimage.gaussian_filter with 'reflect' mode.
+
+    Parameters
+    ----------
+    ima : np.ndarray
+        Image.
+    sigmas : sequence of floats
+        Gaussian standard deviation along each axis in voxels.
+    nr_threads : int
+        Number of threads used by the FFTs. 0 uses all available cores.
+
+    Yields
+    ------
+    gra : np.ndarray
+        Derivative along the next axis, in units of intensity per voxel.
+
+    """
+    nr_threads = nr_threads if nr_threads > 0 else cpu_count()
+    radii = [int(4. * sigma + 0.5) for sigma in sigmas]
+    padded = np.pad(ima, [(r, r) for r in radii], mode='symmetric')
+    shape = [fft.next_fast_len(n) for n in padded.shape[:-1]]
+    shape.append(fft.next_fast_len(padded.shape[-1], real=True))
+    spectrum = fft.rfftn(padded, s=shape, workers=nr_threads)
+    del padded
+    core = tuple(slice(r, r + n) for r, n in zip(radii, ima.shape))
+    # transfer functions of the smoothing and derivative kernels
+    transfer = []
+    for axis, (sigma, radius, n) in enumerate(zip(sigmas, radii, shape)):
+        transform = fft.rfft if axis == ima.ndim - 1 else fft.fft
+        bcast = [1] * ima.ndim
+        bcast[axis] = -1
+        kernels = []
+        for order in (0, 1):
+            kernel = np.zeros(n)
+            weights = gaussian_kernel1d(sigma, order, radius)
+            kernel[:radius + 1] = weights[radius:]
+            kernel[n - radius:] = weights[:radius]
+            kernels.append(transform(kernel).astype(
+                spectrum.dtype).reshape(bcast))
+        transfer.append(kernels)
+    for axis in range(ima.ndim):
+        filt = spectrum
+        for other_axis in range(ima.ndim):
+            filt = filt * transfer[other_axis][int(other_axis == axis)]
+        gra = fft.irfftn(filt, s=shape, workers=nr_threads)[core]
+        yield np.ascontiguousarray(gra, dtype=ima.dtype)
+
+
+def compute_gaussian_gradient_magnitude(ima, sigma=1., voxel_size=None,
+                                        fft_sigma=3., nr_threads=0):
+    """Compute Gaussian derivative gradient magnitude.
+
+    Small scales are filtered with separable FIR kernels, scales of at least
+    fft_sigma voxels with FFT convolutions. The magnitude is multiplied by
+    sigma * sqrt(pi/2), which makes it independent of the scale and gives
+    half of the contrast of a step edge, like central differences.
+
+    Parameters
+    ----------
+    ima : np.ndarray
+        Intensity image.
+    sigma : float
+        Gaussian standard deviation, in the units of voxel_size (often mm).
+    voxel_size : sequence of floats or None
+        Voxel dimensions (eg. pixdim of the nifti header). None uses
+        isotropic voxels of size 1.
+    fft_sigma : float
+        Largest Gaussian standard deviation in voxels where FIR kernels are
+        used.
+    nr_threads : int
+        Number of threads used by the FFTs. 0 uses all available cores.
+
+    Returns
+    -------
+    gra_mag : np.ndarray
+        Gradient magnitude image.
+
+    """
+    voxel_size = np.ones(ima.ndim) if voxel_size is None else \
+        np.asarray(tuple(voxel_size)[:ima.ndim], dtype=np.float64)
+    sigmas = sigma / voxel_size
+    if np.max(sigmas) >= fft_sigma:
+        gradients = iter_gaussian_gradients_fft(ima, sigmas, nr_threads)
+    else:
+        gradients = (gaussian_filter(ima, sigmas, order=np.eye(
+            ima.ndim, dtype=int)[axis], output=ima.dtype, truncate=4.)
+            for axis in range(ima.ndim))
+    gra_mag = np.zeros(ima.shape, dtype=ima.dtype)
+    for axis, gra in enumerate(gradients):
+        gra /= voxel_size[axis]  # intensity per unit of voxel_size
+        gra_mag += gra * gra
+    np.sqrt(gra_mag, out=gra_mag)
+    gra_mag *= sigma * np.sqrt(np.pi / 2)
+    return gra_mag
+
+
+def get_crop_margin(gramag_option, voxel_size=None):
+    """Number of voxels kept around the foreground by find_crop.
+
+    Large gradient kernels need more than cfg.crop_margin voxels to give the
+    same foreground gradients in the cropped image as in the whole image.
+    The recursive Deriche filter reads whole scanlines and normalizes with
+    the range of the whole image, so images are not cropped for it.
+
+    Parameters
+    ----------
+    gramag_option : string
+        Gradient magnitude keyword or path, see set_gradient_magnitude.
+    voxel_size : sequence of floats or None
+        Voxel dimensions, None uses isotropic voxels of size 1.
+
+    Returns
+    -------
+    margin : int or None
+        None when the image should not be cropped.
+
+    """
+    if gramag_option == 'deriche':
+        return None
+    if gramag_option != 'gaussian':
+        return cfg.crop_margin
+    voxel_size = [1.] if voxel_size is None else voxel_size
+    radius = int(4. * cfg.gramag_sigma / np.min(voxel_size) + 0.5)
+    return cfg.crop_margin + radius
+
+
+def compute_gradient_magnitude(ima, method='scharr', verbose=True,
+                               nr_threads=None, voxel_size=None):
     """Compute gradient magnitude of images.
 
     Parameters
@@ -252,7 +1418,16 @@ def compute_gradient_magnitude(ima, method='scharr'):
         First image, which is often the intensity image (eg. T1w).
     method : string
         Gradient computation method. Available options are 'scharr',
-        'sobel', 'prewitt', 'numpy'.
+        'sobel', 'prewitt', 'numpy', 'deriche', 'gaussian'.
+    verbose : bool
+        Print progress and duration.
+    nr_threads : int or None
+        Number of threads. 0 uses all available cores, None uses
+        cfg.nr_threads.
+    voxel_size : sequence of floats or None
+        Voxel dimensions, only used by the 'gaussian' method. None uses
+        isotropic voxels of size 1.
+
     Returns
     -------
     gra_mag : np.ndarray
@@ -261,46 +1436,42 @@ def compute_gradient_magnitude(ima, method='scharr'):
 
     """
     start = time()
-    print('  Computing gradients...')
-    if method.lower() == 'sobel':  # magnitude scale is similar to numpy method
-        kernel = create_3D_kernel(operator=method)
-        gra = np.zeros(ima.shape + (kernel.shape[0],))
-        for d in range(kernel.shape[0]):
-            gra[..., d] = convolve(ima, kernel[d, ...])
-        # compute generic gradient magnitude with normalization
-        gra_mag = np.sqrt(np.sum(np.power(gra, 2.), axis=-1) * 2.)
-    elif method.lower() == 'prewitt':
-        kernel = create_3D_kernel(operator=method)
-        gra = np.zeros(ima.shape + (kernel.shape[0],))
-        for d in range(kernel.shape[0]):
-            gra[..., d] = convolve(ima, kernel[d, ...])
-        # compute generic gradient magnitude with normalization
-        gra_mag = np.sqrt(np.sum(np.power(gra, 2.), axis=-1) * 2.)
-    elif method.lower() == 'scharr':
-        kernel = create_3D_kernel(operator=method)
-        gra = np.zeros(ima.shape + (kernel.shape[0],))
-        for d in range(kernel.shape[0]):
-            gra[..., d] = convolve(ima, kernel[d, ...])
-        # compute generic gradient magnitude with normalization
-        gra_mag = np.sqrt(np.sum(np.power(gra, 2.), axis=-1) * 2.)
-    elif method.lower() == 'numpy':
-        gra = np.asarray(np.gradient(ima))
-        gra_mag = np.sqrt(np.sum(np.power(gra, 2.), axis=0))
+    if verbose:
+        print('  Computing gradients...')
+    ima = np.asarray(ima, dtype=cfg.dtype)
+    if nr_threads is None:
+        nr_threads = cfg.nr_threads
+    # sobel magnitude scale is similar to numpy method
+    if method.lower() in ['scharr', 'sobel', 'prewitt', 'numpy']:
+        if ima.ndim == 3:
+            gra_mag = compute_slab_gradient_magnitude(
+                ima, method.lower(), nr_threads,
+                slab_depth=cfg.slab_depth if cfg.slab_depth > 0 else None)
+        else:
+            gra_mag = compute_local_gradient_magnitude(ima, method.lower())
     elif method.lower() == 'deriche':
         from segmentator.deriche_prepare import Deriche_Gradient_Magnitude
         alpha = cfg.deriche_alpha
         print('    Selected alpha: {}'.format(alpha))
         ima = np.ascontiguousarray(ima, dtype=np.float32)
-        gra_mag = Deriche_Gradient_Magnitude(ima, alpha, normalize=True)
+        gra_mag = Deriche_Gradient_Magnitude(ima, alpha, normalize=True,
+                                             nr_threads=nr_threads)
+        gra_mag = gra_mag.astype(cfg.dtype, copy=False)
+    elif method.lower() == 'gaussian':
+        sigma = cfg.gramag_sigma
+        print('    Selected sigma: {}'.format(sigma))
+        gra_mag = compute_gaussian_gradient_magnitude(
+            ima, sigma, voxel_size, nr_threads=nr_threads)
     else:
         print('  Gradient magnitude method is invalid!')
     end = time()
-    print("  Gradient magnitude computed in: " + str(int(end-start))
-          + " seconds.")
+    if verbose:
+        print("  Gradient magnitude computed in: " + str(int(end-start))
+              + " seconds.")
     return gra_mag
 
 
-def set_gradient_magnitude(image, gramag_option):
+def set_gradient_magnitude(image, gramag_option, crop=None, voxel_size=None):
     """Set gradient magnitude based on the command line flag.
 
     Parameters
@@ -309,6 +1480,11 @@ def set_gradient_magnitude(image, gramag_option):
         First image, which is often the intensity image (eg. T1w).
     gramag_option : string
         A keyword string or a path to a nifti file.
+    crop : tuple of slices or None
+        Bounding box of image, see find_crop. Applied to the loaded gradient
+        magnitude file after its range is truncated and scaled.
+    voxel_size : sequence of floats or None
+        Voxel dimensions, used by the 'gaussian' option.
 
     Returns
     -------
@@ -319,19 +1495,123 @@ def set_gradient_magnitude(image, gramag_option):
     if gramag_option not in cfg.gramag_options:
         print("Selected gradient magnitude method is not available,"
               + " interpreting as a file path...")
-        gra_mag_nii = load(gramag_option)
-        gra_mag = np.squeeze(gra_mag_nii.get_fdata())
-        gra_mag, _ = check_data(gra_mag, cfg.force_original_precision)
-        gra_mag, _, _ = truncate_range(gra_mag, percMin=cfg.perc_min,
-                                       percMax=cfg.perc_max)
-        gra_mag = scale_range(gra_mag, scale_factor=cfg.scale, delta=0.0001)
+        gra_mag, _ = load_data(load_nifti(gramag_option),
+                               cfg.force_original_precision, cfg.dtype)
+        gra_mag, _, _ = preprocess_range(
+            gra_mag, percMin=cfg.perc_min, percMax=cfg.perc_max,
+            scale_factor=cfg.scale, delta=0.0001, exact=cfg.exact_percentiles)
+        if crop is not None:
+            gra_mag = np.ascontiguousarray(gra_mag[crop])
 
     else:
         print('{} gradient method is selected.'.format(gramag_option.title()))
-        gra_mag = compute_gradient_magnitude(image, method=gramag_option)
+        gra_mag = compute_gradient_magnitude(image, method=gramag_option,
+                                             voxel_size=voxel_size)
     return gra_mag
 
 
+def prep_2D_hist_slabs(nii, gramag_option='scharr', slab_depth=32,
+                       percMin=2.5, percMax=97.5, scale_factor=500, delta=0,
+                       discard_zeros=True):
+    """Prepare 2D histogram counts without loading the whole image.
+
+    The image is read in slabs along the third axis several times: for the
+    percentile sketch, the range of the scaled image and finally for the
+    gradient magnitude (with a one slice halo) and the counts. The results
+    are identical to preprocess_range, compute_gradient_magnitude and
+    prep_2D_hist applied to the whole image.
+
+    Parameters
+    ----------
+    nii : nibabel image
+        Input image, see io_utils.load_nifti.
+    gramag_option : string
+        Gradient magnitude method, one of the 3x3x3 stencil methods
+        ('scharr', 'sobel', 'prewitt') or 'numpy'.
+    slab_depth : int
+        Number of slices that are processed at once.
+    percMin : float
+        Minimum percentile to be truncated.
+    percMax : float
+        Maximum percentile to be truncated.
+    scale_factor : float
+        Truncated data is scaled between 0 to this number.
+    delta : float
+        Delta ensures that the max data points fall inside the last bin.
+    discard_zeros : bool
+        Discard voxels with value 0 from truncation, scaling and counts.
+
+    Returns
+    -------
+    counts : np.ndarray, shape(nr_bins, nr_bins)
+        2D histogram counts, see prep_2D_hist.
+    d_min : float
+        Minimum of the first image.
+    d_max : float
+        Maximum of the first image.
+    nr_bins : integer
+        Number of one dimensional bins (not the pixels).
+    bin_edges : np.ndarray
+        Edges of the one dimensional bins.
+
+    Raises
+    ------
+    ValueError
+        If no voxels are left for the histogram.
+
+    """
+    def raw_chunks():
+        for slab, _ in iter_slabs(nii, slab_depth, dtype=cfg.dtype):
+            yield slab.ravel()
+
+    def scaled_slabs(halo=0):
+        for slab, core in iter_slabs(nii, slab_depth, halo, cfg.dtype):
+            slab, _ = truncate_scale_range(
+                slab, pMin, pMax, scale_factor=scale_factor, delta=delta,
+                discard_zeros=discard_zeros, data_min=data_min,
+                data_max=data_max, inplace=True)
+            yield slab, core
+
+    print('  Preparing percentile sketch...')
+    sketch = stream_percentile_sketch(raw_chunks, discard_zeros)
+    data_min, data_max = sketch_range(sketch)
+    empty_msg = 'No voxels to build the histogram from, the image only has ' \
+        'zero or NaN values.'
+    if not np.isfinite(data_min):
+        raise ValueError(empty_msg)
+    pMin, pMax = sketch_percentile(sketch, [percMin, percMax])
+
+    print('  Finding histogram range...')
+    d_min, d_max = None, None
+    for slab, _ in scaled_slabs():
+        if discard_zeros:
+            slab = slab[~np.isclose(slab, 0)]
+        slab = slab[~np.isnan(slab)]
+        if slab.size > 0:
+            d_min = np.min(slab) if d_min is None else min(d_min,
+                                                           np.min(slab))
+            d_max = np.max(slab) if d_max is None else max(d_max,
+                                                           np.max(slab))
+    if d_min is None:
+        raise ValueError(empty_msg)
+    d_min, d_max = np.round(d_min), np.round(d_max)
+    nr_bins = int(d_max - d_min)
+    bin_edges = np.arange(d_min, d_max+1)
+
+    print('  Computing gradients and counts...')
+    counts = np.zeros(nr_bins*nr_bins + 1, dtype=np.int64)
+    for slab, core in scaled_slabs(halo=1):
+        gra = compute_gradient_magnitude(slab, method=gramag_option,
+                                         verbose=False)[:, :, core]
+        ima = slab[:, :, core].ravel()
+        vox2pixMap = map_ima_to_2D_hist(ima, gra.ravel(), bin_edges)
+        if discard_zeros:
+            vox2pixMap = vox2pixMap[~np.isclose(ima, 0)]
+        counts += np.bincount(vox2pixMap, minlength=nr_bins*nr_bins + 1)
+    counts = counts[:-1].reshape(nr_bins, nr_bins).T
+    return counts, d_min, d_max, nr_bins, bin_edges
+
+
 def export_gradient_magnitude_image(img, filename, filtername, affine):
     """Export computed gradient magnitude image as a nifti file."""
     basename = filename.split(os.extsep, 1)[0]
@@ -340,9 +1620,13 @@ def export_gradient_magnitude_image(img, filename, filtername, affine):
         filtername = '{}_alpha{}'.format(filtername.title(),
                                          cfg.deriche_alpha)
         filtername = filtername.replace('.', 'pt')
+    elif filtername == 'gaussian':  # same for sigma
+        filtername = '{}_sigma{}'.format(filtername.title(), cfg.gramag_sigma)
+        filtername = filtername.replace('.', 'pt')
     else:
         filtername = filtername.title()
-    out_path = '{}_GraMag{}.nii.gz'.format(basename, filtername)
+    out_path = '{}_GraMag{}{}'.format(basename, filtername,
+                                      get_nifti_ext(cfg.compresslevel))
     print("Exporting gradient magnitude image...")
-    save(out_img, out_path)
+    save_nifti(out_img, out_path, cfg.compresslevel, cfg.nr_threads)
     print('  Gradient magnitude image exported in this path:\n  ' + out_path)
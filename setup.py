@@ -8,11 +8,23 @@ To install for development, using the commandline do:
 from setuptools import setup
 from setuptools.extension import Extension
 from os.path import join
+import sys
 import numpy
 
+# OpenMP parallelizes the Deriche filter scanlines. Apple clang does not ship
+# OpenMP, the filter then runs on a single thread.
+if sys.platform == 'win32':
+    openmp_args = ['/openmp']
+elif sys.platform == 'darwin':
+    openmp_args = []
+else:
+    openmp_args = ['-fopenmp']
+
 ext_modules = [Extension(
     "segmentator.deriche_3D", [join('segmentator', 'cython', 'deriche_3D.c')],
-    include_dirs=[numpy.get_include()])
+    include_dirs=[numpy.get_include()],
+    extra_compile_args=openmp_args,
+    extra_link_args=[] if sys.platform == 'win32' else openmp_args)
     ]
 
 setup(name='segmentator',
@@ -25,6 +37,8 @@ setup(name='segmentator',
       license='BSD-3-clause',
       packages=['segmentator'],
       install_requires=['numpy>=1.17', 'matplotlib>=3.1', 'scipy>=1.3', 'compoda>=0.3'],
+      extras_require={'indexed_gzip': ['indexed_gzip>=1.0'],
+                      'dicom': ['pydicom>=2.0']},
       keywords=['mri', 'segmentation', 'image', 'voxel'],
       zip_safe=True,
       entry_points={